@@ -0,0 +1,218 @@
+#!/usr/bin/python
+'''
+add_sample_name.py
+
+Add Australian microbiome sampleID, plate ID and amplicon information to the definition lines of fasta formatted
+sequence files.  A python replacement for add_sample_name.sh that does not need the amplicon edited into the script.
+
+Input files are required to be in the format:
+    sampleID_plateID.fasta  (or sampleID_plateID.fasta.gz)
+
+As in add_sample_name.sh, the sample name is the part of the file name before the first "." and each definition line
+is changed from >seqID to >sample=sampleID_plateID;<amplicon>_seqID.  Only lines starting with > are changed.
+
+Files are rewritten in place (or written to --outdir) through a temporary file that replaces the original once
+complete, so an interrupted run never leaves a half written file.  Gzipped files are read and written gzipped.
+Files are processed in parallel, one per core unless -p is given.
+
+With --merge all of the tagged records are written to one fasta file instead, bgzip compressed if its name ends with
+.gz.  Sequence lines are joined onto one line per record.  Alongside it are written:
+    <merged>.fai          - samtools faidx compatible index of every record
+    <merged>.gzi          - bgzip block index (compressed files only), as made by `bgzip -i`
+    <merged>.samples.tsv  - for each sampleID_plateID, its first record, number of records and byte range
+so that the reads of one sample can be fetched with a seek rather than a scan of the whole file (--fetch).
+
+Usage:
+python add_sample_name.py --amplicon 16S                      > all *.fasta and *.fasta.gz files in the current directory
+python add_sample_name.py --amplicon ITS1 -p 8 plate1/*.fasta > the given files
+python add_sample_name.py --amplicon 16S --merge plate1.fasta.gz plate1/*.fasta
+python add_sample_name.py --fetch sampleID_plateID plate1.fasta.gz > sampleID_plateID.fasta
+'''
+
+import argparse
+import bisect
+import glob
+import gzip
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from am_long_table import BgzfWriter, open_table
+
+#bytes read at a time
+block_size = 4 * 1024 * 1024
+
+
+def sample_name(path):
+    #the part of the file name before the first "." e.g., sampleID_plateID
+    return os.path.basename(path).split('.')[0]
+
+
+def tag_headers(blocks, prefix):
+    '''
+    Yield the blocks with prefix added after the > of every definition line.
+    Blocks are cut on line boundaries so every line start is either the start of a block or follows a newline
+    '''
+    tail = b''
+    for block in blocks:
+        block = tail + block
+        cut = block.rfind(b'\n') + 1
+        block, tail = block[:cut], block[cut:]
+        if block:
+            yield (b'\n' + block).replace(b'\n>', b'\n>' + prefix)[1:]
+    if tail:
+        yield (b'\n' + tail).replace(b'\n>', b'\n>' + prefix)[1:]
+
+
+def tag_file(path, amplicon, outdir=None):
+    '''
+    Tag the definition lines of one fasta file, writing it through a temporary file.
+    Returns the file written
+    '''
+    name = sample_name(path)
+    prefix = ('sample=' + name + ';' + amplicon + '_').encode()
+    output = os.path.join(outdir, os.path.basename(path)) if outdir else path
+    #the temporary file keeps the output's extension, which open_table() compresses by
+    tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(output)), prefix='.' + os.path.basename(output) + '.',
+                                      suffix=os.path.splitext(output)[1], delete=False)
+    tmp.close()
+    try:
+        with open_table(path, 'r') as fasta, open_table(tmp.name, 'w') as tagged:
+            for block in tag_headers(iter(lambda: fasta.read(block_size), b''), prefix):
+                tagged.write(block)
+        shutil.copymode(path, tmp.name)
+        os.replace(tmp.name, output)
+    except BaseException:
+        os.remove(tmp.name)
+        raise
+    return output
+
+
+def tag_records(path, amplicon):
+    '''
+    Tag the definition lines of one fasta file and join each record's sequence onto one line.
+    Returns the sample name, the tagged records and, for each record, its name, sequence length and
+    the offset of its sequence within the returned records
+    '''
+    name = sample_name(path)
+    prefix = b'>sample=' + name.encode() + b';' + amplicon.encode() + b'_'
+    with open_table(path, 'r') as fasta:
+        lines = fasta.read().splitlines()
+    out = bytearray()
+    records = []
+    header, seq = None, []
+    for line in lines + [b'>']:
+        if line.startswith(b'>'):
+            if header is not None:
+                out += header + b'\n'
+                sequence = b''.join(seq)
+                records.append((header[1:].split(None, 1)[0].decode(), len(sequence), len(out)))
+                out += sequence + b'\n'
+            header, seq = prefix + line[1:], []
+        elif line:
+            seq.append(line)
+    return name, bytes(out), records
+
+
+def merge_files(files, amplicon, merged, processes=None):
+    '''
+    Tag the files into one merged fasta with .fai, .gzi (if compressed) and .samples.tsv indexes
+    '''
+    compressed = merged.endswith('.gz')
+    out = BgzfWriter(merged) if compressed else open(merged, 'wb')
+    with open(merged + '.fai', 'w') as fai, open(merged + '.samples.tsv', 'w') as sample_index:
+        sample_index.write("sample\tfirst_record\trecords\tstart\tend\n")
+        offset = 0
+        n_records = 0
+
+        def write(tagged):
+            nonlocal offset, n_records
+            name, data, records = tagged
+            out.write(data)
+            for record, length, seq_offset in records:
+                fai.write(record + "\t" + str(length) + "\t" + str(offset + seq_offset) + "\t" + str(length) + "\t" + str(length + 1) + "\n")
+            sample_index.write(name + "\t" + str(n_records) + "\t" + str(len(records)) + "\t" + str(offset) + "\t" + str(offset + len(data)) + "\n")
+            print("tagged " + str(len(records)) + " records of sample " + name)
+            n_records += len(records)
+            offset += len(data)
+
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            #keep a bounded number of files in flight so tagged data does not pile up in memory, writing in input order
+            max_pending = 2 * (processes or os.cpu_count() or 1)
+            pending = deque()
+            for file in files:
+                pending.append(pool.submit(tag_records, file, amplicon))
+                if len(pending) >= max_pending:
+                    write(pending.popleft().result())
+            while pending:
+                write(pending.popleft().result())
+    out.close()
+    if compressed:
+        out.write_gzi(merged + '.gzi')
+
+
+def read_range(merged, start, end):
+    '''
+    Read bytes start to end (uncompressed offsets) of a merged fasta, seeking via the .gzi index if it is compressed
+    '''
+    with open(merged, 'rb') as f:
+        if not merged.endswith('.gz'):
+            f.seek(start)
+            return f.read(end - start)
+        blocks = [(0, 0)]
+        with open(merged + '.gzi', 'rb') as gzi:
+            n = struct.unpack('<Q', gzi.read(8))[0]
+            data = gzi.read(16 * n)
+            blocks += [struct.unpack_from('<2Q', data, 16 * i) for i in range(n)]
+        i = bisect.bisect_right([uncompressed for compressed, uncompressed in blocks], start) - 1
+        f.seek(blocks[i][0])
+        with gzip.GzipFile(fileobj=f) as reader:
+            reader.read(start - blocks[i][1])
+            return reader.read(end - start)
+
+
+def fetch_sample(merged, sample):
+    '''
+    Return the tagged records of one sample from a merged fasta
+    '''
+    with open(merged + '.samples.tsv') as sample_index:
+        next(sample_index)
+        for line in sample_index:
+            name, first, records, start, end = line.rstrip('\n').split('\t')
+            if name == sample:
+                return read_range(merged, int(start), int(end))
+    raise KeyError(sample + " is not in " + merged)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Add sample, plate and amplicon names to fasta definition lines")
+    parser.add_argument('files', nargs='*', help="fasta files named sampleID_plateID.fasta[.gz] (default: all in the current directory)")
+    parser.add_argument('-a', '--amplicon', help="amplicon e.g., 16S, A16S, 18Sv4, 18Sv9, ITS1 or ITS2")
+    parser.add_argument('-o', '--outdir', help="write tagged files to this directory instead of rewriting them in place")
+    parser.add_argument('-p', '--processes', type=int, default=None, help="number of files to tag at once (default: all cores)")
+    parser.add_argument('-m', '--merge', help="write all tagged records to this indexed fasta (bgzip compressed if it ends with .gz)")
+    parser.add_argument('--fetch', metavar='SAMPLE', help="write the records of one sampleID_plateID from the merged fasta given as the file")
+    args = parser.parse_args()
+
+    if args.fetch:
+        if len(args.files) != 1:
+            parser.error("--fetch needs the merged fasta file")
+        sys.stdout.buffer.write(fetch_sample(args.files[0], args.fetch))
+        parser.exit()
+    if not args.amplicon:
+        parser.error("the --amplicon argument is required")
+
+    files = args.files or sorted(glob.glob('*.fasta') + glob.glob('*.fasta.gz'))
+    if args.merge:
+        merge_files(files, args.amplicon, args.merge, args.processes)
+        print("merged " + str(len(files)) + " files to " + args.merge)
+        parser.exit()
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        for path, output in zip(files, pool.map(tag_file, files, [args.amplicon] * len(files), [args.outdir] * len(files), chunksize=16)):
+            print("tagged " + output + " with sample " + sample_name(path))
+    print("tagged " + str(len(files)) + " files")
@@ -12,6 +12,10 @@
 #
 #Replace <amplicon> in the second last line with the appropriate amplicon (e.g., 16S, A16S, 18Sv4, 18Sv9, ITS1 or ITS2), for example:
 #	`perl -pi -e 's/\>/\>sample='$VAR1';16S_/' $file;`
+#
+#add_sample_name.py does the same without editing the script, only changes lines starting with > and is much faster
+#for large numbers of files, e.g.:
+#	python add_sample_name.py --amplicon 16S
 #####
 
 #this initiates the loop for all files with extension .fasta in the list generated by ls -l
@@ -0,0 +1,223 @@
+'''
+Progress, timing and memory instrumentation shared by reformat_AM_3col.py, metagenomeFileCollector.py and
+convert_CSBP_to_AM.py
+
+Each script times its stages (e.g., read, pivot, merge and write) with:
+    with am_instrument.stage('read', file=infile) as read:
+        for chunk in chunks:
+            read.add(rows=len(chunk))
+
+Everything is off unless turned on with the options added by add_arguments():
+    --log FILE      append a JSON line for each stage to FILE: seconds, counts (rows, bytes, ...) and their rates,
+                    and the peak RSS of the process so far
+    --progress      show a live progress line (rate, and ETA when the total is known) on stderr
+    --profile cprofile|tracemalloc
+                    profile each stage.  cProfile stats are saved as <log>.<stage>.<pid>.<n>.prof (read them with
+                    `python -m pstats`), tracemalloc adds the stage's peak traced memory and top allocation sites
+                    to its log line.  Needs --log (am_profile.jsonl is used if it is not given)
+When off, stage() returns a shared object that does nothing, so the cost is one function call per stage or count.
+
+Stages run in worker processes are logged from the workers (the log lines are written with single appends); pass
+worker_settings() as the initargs of configure() when making a process pool so workers log to the same file.
+'''
+
+import json
+import os
+import sys
+import time
+
+log_path = None
+show_progress = False
+profile = None
+enabled = False
+
+#number of cProfile files written by this process, and whether a stage is being profiled
+profiles_written = 0
+profiling = False
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group('instrumentation')
+    group.add_argument('--log', metavar='FILE', help="append timing, counts and memory of each stage to this JSON lines file")
+    group.add_argument('--progress', action='store_true', help="show a live progress line")
+    group.add_argument('--profile', choices=['cprofile', 'tracemalloc'], help="profile each stage (results go with the --log file)")
+
+
+def configure(log=None, progress=False, profile_mode=None):
+    global log_path, show_progress, profile, enabled
+    if profile_mode and not log:
+        log = 'am_profile.jsonl'
+    log_path, show_progress, profile = log, progress, profile_mode
+    enabled = bool(log or progress or profile_mode)
+
+
+def configure_from_args(args):
+    configure(args.log, args.progress, args.profile)
+
+
+def worker_settings():
+    #settings for configure() in pool workers, which log but do not show progress
+    return (log_path, False, profile)
+
+
+def peak_rss():
+    '''
+    Peak resident memory of this process in bytes (None if it can not be read)
+    '''
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset
+        except (ImportError, AttributeError):
+            return None
+    #ru_maxrss is in kilobytes on linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def write_log(record):
+    if log_path is None:
+        return
+    record = dict({'time': round(time.time(), 3), 'pid': os.getpid(), 'script': os.path.basename(sys.argv[0])}, **record)
+    with open(log_path, 'a') as log:
+        log.write(json.dumps(record, default=str) + '\n')
+
+
+def event(name, **fields):
+    '''
+    Log a one off event (e.g., the end of a run) with the peak RSS of the process
+    '''
+    if enabled:
+        write_log(dict({'event': name, 'peak_rss_bytes': peak_rss()}, **fields))
+
+
+def duration(seconds):
+    seconds = int(seconds)
+    return '{:d}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Timer:
+    #adds the time spent in a with block to a stage's named timer
+    def __init__(self, timers, name):
+        self.timers, self.name = timers, name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timers[self.name] = self.timers.get(self.name, 0) + time.perf_counter() - self.start
+        return False
+
+
+class Stage:
+    '''
+    Times a stage, counts what it processed and logs it when it ends
+    '''
+    def __init__(self, name, total, unit, fields):
+        self.name, self.total, self.unit, self.fields = name, total, unit, fields
+        self.counts = {}
+        self.timers = {}
+        self.profiler = None
+        self.shown = 0
+
+    def __enter__(self):
+        global profiling
+        if profile == 'cprofile' and not profiling:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            profiling = True
+        elif profile == 'tracemalloc' and not profiling:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self.profiler = tracemalloc
+            profiling = True
+        self.start = time.perf_counter()
+        return self
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+        if show_progress and time.perf_counter() - self.shown > 0.2:
+            self.show()
+
+    def timer(self, name):
+        return Timer(self.timers, name)
+
+    def show(self, end=''):
+        self.shown = time.perf_counter()
+        seconds = self.shown - self.start
+        done = self.counts.get(self.unit, 0)
+        line = '[' + self.name + '] '
+        if self.unit in self.counts or self.total:
+            line += '{:,}'.format(done) + ' ' + self.unit
+            if self.total:
+                line += ' of ' + '{:,}'.format(self.total) + ' ({:.0%})'.format(done / self.total)
+            line += ', {:,.0f} {}/s, '.format(done / max(seconds, 1e-9), self.unit)
+        line += duration(seconds)
+        if self.total and done and not end:
+            line += ', ETA ' + duration(seconds * (self.total - done) / done)
+        sys.stderr.write('\r' + line.ljust(79) + end)
+        sys.stderr.flush()
+
+    def __exit__(self, exc_type, exc, tb):
+        global profiles_written, profiling
+        seconds = time.perf_counter() - self.start
+        record = dict({'event': 'stage', 'stage': self.name, 'seconds': round(seconds, 4)}, **self.fields)
+        for key, value in self.counts.items():
+            record[key] = value
+            record[key + '_per_second'] = round(value / max(seconds, 1e-9), 1)
+        for key, value in self.timers.items():
+            record[key + '_seconds'] = round(value, 4)
+        record['peak_rss_bytes'] = peak_rss()
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        if self.profiler is not None and profile == 'cprofile':
+            self.profiler.disable()
+            profiles_written += 1
+            path = os.path.splitext(log_path)[0] + '.' + self.name.replace(' ', '_') + '.' + str(os.getpid()) + '.' + str(profiles_written) + '.prof'
+            self.profiler.dump_stats(path)
+            record['profile'] = path
+            profiling = False
+        elif self.profiler is not None:
+            record['traced_peak_bytes'] = self.profiler.get_traced_memory()[1]
+            top = self.profiler.take_snapshot().statistics('lineno')[:5]
+            record['top_allocations'] = [[str(stat.traceback), stat.size] for stat in top]
+            profiling = False
+        if show_progress:
+            self.show(end='\n')
+        write_log(record)
+        return False
+
+
+class NullStage:
+    #stands in for Stage when instrumentation is off
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **counts):
+        pass
+
+    def timer(self, name):
+        return self
+
+
+null_stage = NullStage()
+
+
+def stage(name, total=None, unit='rows', **fields):
+    '''
+    A stage to time in a with block.
+    total - expected count of unit (e.g., rows or files) for the progress line's ETA
+    fields - extra values for the log line, e.g., file=infile
+    '''
+    if not enabled:
+        return null_stage
+    return Stage(name, total, unit, fields)
@@ -0,0 +1,216 @@
+'''
+Read long (3 col + taxonomy) format abundance tables as exported by the AM data portal https://data.bioplatforms.com/bpa/otu/
+
+Used by reformat_AM_3col.py, sub_sample_AM_zotuTABLE_by_sample_id.py and collapse_AM_taxonomy.py (and
+am_wide_table.py for the taxonomy columns, add_sample_name.py to open fasta files).
+
+Tables can be plain csv or compressed (.gz, .bgz or .zst).  .bgz tables are written in bgzip (BGZF) blocks with
+BgzfWriter (also used for the merged fasta of add_sample_name.py) so htslib tools can read them.  The header can be
+checked against expected_cols without reading the rest of the file.  Tables are read with pyarrow (`pip install pyarrow`, pandas is used if it is not
+installed).  'Sample ID', 'OTU', 'Amplicon' and the taxonomy columns are read as categoricals, so each distinct name is
+stored once rather than on every row, and 'OTU Count' as uint32.  Only the columns asked for are read, and if a list
+of Sample IDs is given the rows of other samples are dropped as each block is read.  encode() maps the names of
+each block to integer codes that stay the same across blocks.
+
+Usage:
+    import am_long_table
+    if am_long_table.check_header('my_download.csv.gz'):
+        tableL = am_long_table.read_table('my_download.csv.gz', columns=['Sample ID', 'OTU', 'OTU Count'], samples=['102.100.100/12345'])
+'''
+
+import csv
+import gzip
+import io
+import struct
+import zlib
+
+expected_cols=['Sample ID','OTU','OTU Count','Amplicon','Kingdom','Phylum','Class','Order','Family','Genus','Species', 'Traits']
+taxonomy = ['OTU','Amplicon','Kingdom','Phylum','Class','Order','Family','Genus','Species', 'Traits']
+categorical_cols = ['Sample ID'] + taxonomy
+
+#bytes of the table read per block
+block_size = 64 * 1024 * 1024
+
+#largest amount of data put in one bgzip block, and the empty block that ends a bgzip file
+bgzf_block_size = 0xff00
+bgzf_eof = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def open_table(path, mode):
+    '''
+    Open a table for binary reading or writing, (de)compressing gzip/bgzip or zstd files by their extension
+    '''
+    if path.endswith('.bgz') and mode == 'w':
+        return BgzfWriter(path)
+    if path.endswith(('.gz', '.bgz')):
+        return gzip.open(path, mode + 'b', compresslevel=6)
+    if path.endswith('.zst'):
+        import zstandard
+        if mode == 'r':
+            return io.BufferedReader(zstandard.open(path, 'rb'))
+        return zstandard.open(path, 'wb')
+    return open(path, mode + 'b')
+
+
+class BgzfWriter:
+    '''
+    Write a bgzip compressed file, keeping the block offsets for the .gzi index
+    '''
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.buffer = bytearray()
+        self.blocks = [] #(compressed offset, uncompressed offset) of each block
+        self.compressed = 0
+        self.uncompressed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= bgzf_block_size:
+            self.write_block(bytes(self.buffer[:bgzf_block_size]))
+            del self.buffer[:bgzf_block_size]
+
+    def write_block(self, data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, len(deflated) + 25)
+        block = header + deflated + struct.pack('<2I', zlib.crc32(data), len(data))
+        self.blocks.append((self.compressed, self.uncompressed))
+        self.file.write(block)
+        self.compressed += len(block)
+        self.uncompressed += len(data)
+
+    def close(self):
+        if self.buffer:
+            self.write_block(bytes(self.buffer))
+        self.file.write(bgzf_eof)
+        self.file.close()
+
+    def write_gzi(self, path):
+        #the first block (at 0, 0) is implied
+        with open(path, 'wb') as gzi:
+            gzi.write(struct.pack('<Q', len(self.blocks) - 1))
+            for compressed, uncompressed in self.blocks[1:]:
+                gzi.write(struct.pack('<2Q', compressed, uncompressed))
+
+
+def read_header(path):
+    '''
+    Return the column names from the first line of a table
+    '''
+    with open_table(path, 'r') as table:
+        header = table.readline().decode('utf-8-sig')
+    return next(csv.reader([header]))
+
+
+def check_header(path):
+    return read_header(path) == expected_cols
+
+
+def sample_column(header):
+    '''
+    Position of the 'Sample ID' column in a list of column names (the first column if there is none)
+    '''
+    return header.index('Sample ID') if 'Sample ID' in header else 0
+
+
+def tidy_categories(df):
+    #drop categories of rows that were filtered out and sort the rest so categorical order matches string order
+    for col in df.columns:
+        if df[col].dtype == 'category':
+            categories = df[col].cat.remove_unused_categories().cat.categories
+            df[col] = df[col].cat.set_categories(sorted(categories))
+    return df
+
+
+def encode(labels, codes):
+    '''
+    Map a categorical series of labels to integer codes, adding any labels not yet seen to the codes dictionary.
+    Missing (null) labels are coded -1, drop those rows before using the codes as matrix indices
+    '''
+    import numpy as np
+    lookup = np.array([codes.setdefault(label, len(codes)) for label in labels.cat.categories], dtype=np.int64)
+    label_codes = labels.cat.codes.to_numpy()
+    return np.where(label_codes >= 0, lookup[label_codes], -1)
+
+
+def arrow_reader(path, columns):
+    import pyarrow as pa
+    import pyarrow.csv as pv
+    column_types = {col: pa.dictionary(pa.int32(), pa.string()) for col in categorical_cols}
+    column_types['OTU Count'] = pa.uint32()
+    convert_options = pv.ConvertOptions(column_types=column_types, include_columns=columns, strings_can_be_null=True)
+    read_options = pv.ReadOptions(block_size=block_size)
+    source = path if not path.endswith(('.gz', '.bgz', '.zst')) else open_table(path, 'r')
+    return pv.open_csv(source, read_options=read_options, convert_options=convert_options)
+
+
+def filter_batches(reader, samples):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    sample_set = pa.array(sorted(samples), type=pa.string()) if samples is not None else None
+    for batch in reader:
+        if sample_set is not None:
+            batch = batch.filter(pc.is_in(batch.column('Sample ID'), value_set=sample_set))
+        yield batch
+
+
+def iter_table(path, columns=None, samples=None):
+    '''
+    Read a table a block at a time, yielding dataframes with compact dtypes
+
+    columns - only read these columns (must include 'Sample ID' if samples is given)
+    samples - only keep rows of these Sample IDs
+    '''
+    try:
+        import pyarrow
+    except ImportError:
+        pyarrow = None
+    if pyarrow is not None:
+        for batch in filter_batches(arrow_reader(path, columns), samples):
+            yield batch.to_pandas()
+        return
+
+    import pandas as pd
+    dtype = {col: 'category' for col in categorical_cols}
+    dtype['OTU Count'] = 'uint32'
+    compression = 'gzip' if path.endswith('.bgz') else 'infer'
+    rows = max(1, block_size // 200)
+    for chunk in pd.read_csv(path, usecols=columns, dtype=dtype, chunksize=rows, compression=compression):
+        if samples is not None:
+            chunk = chunk[chunk['Sample ID'].isin(samples)]
+        yield chunk
+
+
+def read_table(path, columns=None, samples=None, progress=None):
+    '''
+    Read a whole table (or the chosen columns and samples of it) into one dataframe with compact dtypes
+
+    progress - an am_instrument stage given the rows kept as each block is read
+    '''
+    try:
+        import pyarrow as pa
+    except ImportError:
+        pa = None
+    blocks = []
+    if pa is not None:
+        reader = arrow_reader(path, columns)
+        for batch in filter_batches(reader, samples):
+            blocks.append(batch)
+            if progress is not None:
+                progress.add(rows=batch.num_rows)
+        table = pa.Table.from_batches(blocks, schema=reader.schema)
+        return tidy_categories(table.unify_dictionaries().to_pandas())
+
+    import pandas as pd
+    for chunk in iter_table(path, columns, samples):
+        blocks.append(chunk)
+        if progress is not None:
+            progress.add(rows=len(chunk))
+    return tidy_categories(pd.concat(blocks, ignore_index=True))
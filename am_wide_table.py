@@ -0,0 +1,230 @@
+'''
+Read and write wide format (OTUs x Samples = Rows x Cols) abundance tables as made by reformat_AM_3col.py
+
+Output formats, all written from the output name given to reformat_AM_3col.py:
+    csv     - <output>.csv, OTU abundances followed by the taxonomy columns (the original output format)
+    parquet - <output>.parquet holding the non-zero abundances as OTU, Sample ID, OTU Count rows (sample by sample,
+              in row groups of parquet_row_group rows, with the list of Sample IDs in the file metadata) so its size
+              grows with the number of non-zero counts rather than OTUs x samples, and
+              <output>_taxonomy.parquet with the taxonomy of each OTU (in table row order). Requires pyarrow
+    npz     - <output>.npz scipy.sparse matrix of abundances, with the label sidecars
+              <output>_otus.csv (OTU and taxonomy, one row per matrix row) and
+              <output>_samples.csv (Sample ID, one row per matrix column). Requires scipy
+    mtx     - <output>.mtx MatrixMarket matrix of abundances, with the same label sidecars as npz. Requires scipy
+
+load_wide_table() reopens any of these.  A list of Sample IDs can be given so that only those columns are read,
+parquet files are memory mapped and only the row groups holding the wanted samples are read.  Wide csv tables are
+read a block of rows at a time straight into sparse, so they are never held in memory as a dense table.
+
+Usage (e.g. from an analysis script):
+    import am_wide_table
+    tableW, otus, samples, taxL1 = am_wide_table.load_wide_table('my_table.parquet', samples=['102.100.100/12345'])
+    merge = am_wide_table.to_frame(tableW, otus, samples, taxL1)
+'''
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import am_instrument
+from am_long_table import taxonomy
+
+#file extension of the abundance table for each format
+formats = {'csv': '.csv', 'parquet': '.parquet', 'npz': '.npz', 'mtx': '.mtx'}
+
+#read OTU and Sample IDs and the taxonomy back as written: as text, with only empty cells missing
+label_options = {'dtype': str, 'keep_default_na': False, 'na_values': ['']}
+
+#number of cells of the wide table held in memory at a time when writing or reading in blocks
+block_cells = 20000000
+
+#rows (non-zero counts) in each row group of a parquet table
+parquet_row_group = 1024 * 1024
+
+
+def output_files(output, fmt):
+    '''
+    List the files written for a wide table in a given format
+    '''
+    table_file = output + formats[fmt]
+    if fmt == 'csv':
+        return [table_file]
+    if fmt == 'parquet':
+        return [table_file, output + '_taxonomy.parquet']
+    return [table_file, output + '_otus.csv', output + '_samples.csv']
+
+
+def row_blocks(n_rows, n_cols):
+    '''
+    Yield (start, end) row ranges holding about block_cells cells each
+    '''
+    block_rows = max(1, block_cells // max(1, n_cols))
+    for start in range(0, n_rows, block_rows):
+        yield start, min(start + block_rows, n_rows)
+
+
+def write_wide_table(output, fmt, tableW, otus, samples, taxL1, progress=None):
+    '''
+    Write a wide table in the chosen format
+
+    tableW is a scipy.sparse matrix (OTU x Sample), otus and samples are the row and column labels
+    and taxL1 is the taxonomy indexed by OTU in the same order as the rows of tableW.
+    Each file is written to a temporary name and renamed once complete.
+    progress is an am_instrument stage given the rows (OTUs) written as each block is written.
+    Returns the total abundance written.
+    '''
+    if fmt not in formats:
+        raise ValueError("unknown output format: " + fmt + ", choose one of " + ", ".join(formats))
+    if progress is None:
+        progress = am_instrument.null_stage
+    taxL1 = taxL1.reindex(otus)
+    files = output_files(output, fmt)
+    tmp_files = [f + '.tmp' for f in files]
+    written = 0
+
+    if fmt == 'csv':
+        with open(tmp_files[0], 'w', newline='') as out:
+            for start, end in row_blocks(len(otus), len(samples)):
+                block = pd.DataFrame(tableW[start:end].toarray(), index=otus[start:end], columns=samples)
+                merge = pd.concat([block, taxL1.iloc[start:end]], axis=1) #merge the OTU abundance and taxonomies
+                merge.index.name = 'OTU'
+                written += block.values.sum()
+                merge.to_csv(out, header=(start == 0))
+                progress.add(rows=end - start)
+
+    elif fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        from scipy import sparse
+        tableC = sparse.csc_matrix(tableW)
+        tableC.eliminate_zeros()
+        tableC.sort_indices()
+        otu_names = pa.array(otus.astype(str))
+        sample_names = pa.array(samples.astype(str))
+        metadata = {b'samples': json.dumps([str(s) for s in samples]).encode()}
+        schema = pa.schema([('OTU', pa.dictionary(pa.int32(), pa.string())), ('Sample ID', pa.dictionary(pa.int32(), pa.string())),
+                            ('OTU Count', pa.float64())], metadata=metadata)
+        rows_done = 0
+        with pq.ParquetWriter(tmp_files[0], schema) as writer:
+            for start in range(0, tableC.nnz, parquet_row_group):
+                end = min(start + parquet_row_group, tableC.nnz)
+                cols = np.searchsorted(tableC.indptr, np.arange(start, end), side='right') - 1
+                counts = tableC.data[start:end].astype(np.float64)
+                written += counts.sum()
+                arrays = [pa.DictionaryArray.from_arrays(pa.array(tableC.indices[start:end].astype(np.int32)), otu_names),
+                          pa.DictionaryArray.from_arrays(pa.array(cols.astype(np.int32)), sample_names),
+                          pa.array(counts)]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                #the table is written by sample, so count OTU rows in proportion to the counts written
+                rows = len(otus) * end // tableC.nnz
+                progress.add(rows=rows - rows_done)
+                rows_done = rows
+        taxL1.to_parquet(tmp_files[1], engine='pyarrow')
+        progress.add(rows=len(otus) - rows_done)
+
+    else:
+        from scipy import sparse, io
+        if fmt == 'npz':
+            #save_npz adds .npz to names without it, so give it a file object
+            with open(tmp_files[0], 'wb') as out:
+                sparse.save_npz(out, sparse.csr_matrix(tableW))
+        else:
+            with open(tmp_files[0], 'wb') as out:
+                io.mmwrite(out, sparse.coo_matrix(tableW))
+        written = tableW.sum()
+        taxL1.to_csv(tmp_files[1])
+        pd.Series(samples, name='Sample ID').to_csv(tmp_files[2], index=False)
+        progress.add(rows=len(otus))
+
+    for tmp_file, f in zip(tmp_files, files):
+        os.replace(tmp_file, f)
+    return written
+
+
+def to_frame(tableW, otus, samples, taxL1):
+    '''
+    Make the merged wide table, as written to csv, from the parts returned by load_wide_table()
+    '''
+    tableW = pd.DataFrame(tableW.toarray(), index=otus, columns=samples)
+    merge = pd.concat([tableW, taxL1.reindex(otus)], axis=1)
+    merge.index.name = 'OTU'
+    return merge
+
+
+def select_samples(all_samples, samples):
+    '''
+    Return the positions of the requested samples in the table (in table order), warning about any not found
+    '''
+    if samples is None:
+        return np.arange(len(all_samples))
+    wanted = set(samples)
+    missing = wanted.difference(all_samples)
+    if missing:
+        print("WARNING: " + str(len(missing)) + " sample(s) not found in table: " + ", ".join(sorted(map(str, missing))))
+    return np.flatnonzero(all_samples.isin(wanted))
+
+
+def load_wide_table(path, samples=None):
+    '''
+    Load a wide table written by reformat_AM_3col.py, in any of the supported formats (chosen by file extension)
+
+    If samples is given only those Sample ID columns are read.
+    Returns a scipy.sparse CSR matrix of abundances (OTU x Sample), the OTU labels, the Sample ID labels
+    and the taxonomy indexed by OTU.
+    '''
+    from scipy import sparse, io
+    output, ext = os.path.splitext(path)
+    fmt = {v: k for k, v in formats.items()}.get(ext)
+    if fmt is None:
+        raise ValueError("unknown wide table format: " + path)
+
+    if fmt == 'csv':
+        header = pd.read_csv(path, nrows=0).columns
+        all_samples = header[1:len(header) - len(taxonomy) + 1]
+        keep = select_samples(all_samples, samples)
+        usecols = [header[0]] + all_samples[keep].tolist() + taxonomy[1:]
+        dtype = dict(dict.fromkeys(all_samples[keep], np.float64), **dict.fromkeys([header[0]] + taxonomy[1:], str))
+        #read a block of rows at a time into sparse, so the dense table is never held in memory
+        block_rows = max(1, block_cells // max(1, len(usecols)))
+        blocks, taxa = [], []
+        for chunk in pd.read_csv(path, usecols=usecols, index_col=0, dtype=dtype, keep_default_na=False, na_values=[''], chunksize=block_rows):
+            blocks.append(sparse.csr_matrix(chunk[all_samples[keep]].to_numpy(dtype=np.float64)))
+            taxa.append(chunk[taxonomy[1:]])
+        if not blocks:
+            taxL1 = pd.DataFrame(columns=taxonomy[1:], index=pd.Index([], name=header[0]), dtype=str)
+            return sparse.csr_matrix((0, len(keep))), taxL1.index, all_samples[keep], taxL1
+        taxL1 = pd.concat(taxa)
+        return sparse.vstack(blocks, format='csr'), taxL1.index, all_samples[keep], taxL1
+
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(path, memory_map=True)
+        all_samples = pd.Index(json.loads(pf.schema_arrow.metadata[b'samples']))
+        keep = select_samples(all_samples, samples)
+        taxL1 = pd.read_parquet(output + '_taxonomy.parquet', engine='pyarrow', memory_map=True)
+        otus = taxL1.index
+        if not len(keep):
+            return sparse.csr_matrix((len(otus), 0)), otus, all_samples[keep], taxL1
+        filters = None if samples is None else [('Sample ID', 'in', all_samples[keep].tolist())]
+        table = pq.read_table(path, filters=filters, memory_map=True, read_dictionary=['OTU', 'Sample ID'])
+        rows, cols = [], []
+        for name, labels, out in (('OTU', otus, rows), ('Sample ID', all_samples[keep], cols)):
+            for chunk in table.column(name).chunks:
+                #map the chunk's dictionary to table positions, then its indices through that
+                lookup = labels.get_indexer(chunk.dictionary.to_pandas())
+                out.append(lookup[chunk.indices.to_numpy(zero_copy_only=False)])
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+        counts = table.column('OTU Count').to_numpy()
+        tableW = sparse.csr_matrix((counts, (rows, cols)), shape=(len(otus), len(keep)))
+        return tableW, otus, all_samples[keep], taxL1
+
+    taxL1 = pd.read_csv(output + '_otus.csv', index_col=0, **label_options)
+    all_samples = pd.Index(pd.read_csv(output + '_samples.csv', **label_options)['Sample ID'])
+    keep = select_samples(all_samples, samples)
+    if fmt == 'npz':
+        tableW = sparse.load_npz(path)
+    else:
+        tableW = io.mmread(path)
+    tableW = sparse.csc_matrix(tableW)[:, keep].tocsr()
+    return tableW, taxL1.index, all_samples[keep], taxL1
@@ -0,0 +1,386 @@
+'''
+A benchmark of all of the AM scripts on synthetic data
+
+Makes synthetic inputs of a chosen size for each tool and runs the tools on them without prompts, each in a new
+python process.  The inputs are:
+    AM 3 column table  - samples x OTUs in the portal download format, sorted by Sample ID.  Each sample holds a
+                         random share of the OTUs (--density on average, log-normal between samples), common OTUs
+                         are in more samples than rare ones and counts are log-normal.  Also written gzipped,
+                         and with the rows shuffled (as a table not grouped by sample)
+    sample ID list     - every 4th sample of the table
+    CSBP workbooks     - SOIL and WATER sheets with the CSBP header rows and the columns of known_soil_cols and
+                         known_water_cols in convert_CSBP_to_AM.py, with censored (<0.1) and missing values
+    UTC samples        - samples at random Australian sites (as in benchmark_UTC_converter.py)
+    SQM archives       - one <sample>_SQM.tar.gz per sample holding a run's worth of tables and fasta files
+    fasta files        - sampleID_plateID.fasta files of single line amplicon reads
+
+For each run the wall time, input rows and bytes per second and peak RSS are recorded.  Peak RSS is sampled over the
+whole process tree (including pool workers) if psutil is installed (`pip install psutil`), otherwise it is the peak of
+the main process only (not recorded on Windows).  Each run is repeated --repeat times and the fastest is kept.  The
+results are printed and saved to a JSON file (with the settings, python version and git commit) so runs of different
+versions of the scripts can be compared.
+
+Usage:
+python benchmark_AM_tools.py [--tools reformat subsample ...] [--samples 200] [--otus 20000] [-o benchmark_results.json]
+python benchmark_AM_tools.py --keep bench_data    > keep the synthetic data (made again only if missing)
+'''
+
+import argparse
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from benchmark_UTC_converter import make_samples
+
+here = os.path.dirname(os.path.abspath(__file__))
+tools = ['reformat', 'subsample', 'csbp', 'utc', 'metagenome', 'fasta']
+
+sqm_types = ['sqm.21.stats', 'sqm.orfs.tsv', 'sqm.contigs.tsv', 'sqm.bins.tsv', 'sqm.mcount', 'sqm.fun3.kegg', 'sqm.contigs.fasta', 'sqm.faa']
+
+
+def script(name):
+    return os.path.join(here, name)
+
+
+def sequences(rng, n, length):
+    #n random ACGT strings of the given length
+    bases = np.frombuffer(b'ACGT', dtype=np.uint8)[rng.integers(0, 4, (n, length))]
+    return [row.tobytes().decode() for row in bases]
+
+
+def make_long_table(path, samples, otus, density, seed=0):
+    '''
+    Write a 3 column table of samples x otus, returning the number of rows
+    '''
+    rng = np.random.default_rng(seed)
+    names = np.array([hashlib.md5(str(i).encode()).hexdigest() for i in range(otus)])
+    #OTU popularity falls off with rank, so a few OTUs are in most samples and most OTUs are in a few
+    weights = 1 / np.arange(1, otus + 1) ** 0.8
+    weights /= weights.sum()
+    i = np.arange(otus)
+    taxa = pd.DataFrame({'OTU': names, 'Amplicon': '27f519r_bacteria',
+                         'Kingdom': np.where(i % 50 == 0, 'd__Archaea', 'd__Bacteria'),
+                         'Phylum': ['p__Phylum' + str(k) for k in i % 60],
+                         'Class': ['c__Class' + str(k) for k in i % 200],
+                         'Order': ['o__Order' + str(k) for k in i % 500],
+                         'Family': ['f__Family' + str(k) for k in i % 1500],
+                         'Genus': np.where(i % 3 == 0, '', ['g__Genus' + str(k) for k in i % 4000]),
+                         'Species': np.where(i % 7 == 0, ['s__Species' + str(k) for k in i], ''),
+                         'Traits': ''})
+    richness = np.clip(rng.lognormal(np.log(density * otus), 0.5, samples).astype(int), 1, otus)
+    rows = 0
+    with open(path, 'w', newline='') as table:
+        for s in range(samples):
+            picked = np.sort(rng.choice(otus, richness[s], replace=False, p=weights))
+            chunk = taxa.iloc[picked].copy()
+            chunk.insert(0, 'Sample ID', '102.100.100/' + str(10000 + s))
+            chunk.insert(2, 'OTU Count', np.ceil(rng.lognormal(2, 1.5, len(picked))).astype(int))
+            chunk.to_csv(table, index=False, header=(s == 0))
+            rows += len(chunk)
+    return rows
+
+
+def shuffle_rows(path, shuffled, seed=0):
+    with open(path, 'rb') as table:
+        header = table.readline()
+        lines = table.readlines()
+    np.random.default_rng(seed).shuffle(lines)
+    with open(shuffled, 'wb') as table:
+        table.write(header)
+        table.writelines(lines)
+
+
+def make_sample_ids(path, samples, every=4):
+    with open(path, 'w') as ids:
+        for s in range(0, samples, every):
+            ids.write('102.100.100/' + str(10000 + s) + '\n')
+
+
+def make_csbp(path, columns, rows, seed=0):
+    '''
+    Write a CSBP style workbook: three header rows (with 'Customer' in the first), the column names, a row of units,
+    then the results
+    '''
+    from openpyxl import Workbook
+    rng = np.random.default_rng(seed)
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(['CSBP Limited', None, None, None, None, 'Customer'])
+    sheet.append(['Analysis Report'])
+    sheet.append([None])
+    sheet.append([None if col.startswith('Unnamed') else col for col in columns])
+    sheet.append(['units' if not col.startswith('Unnamed') else None for col in columns])
+    ids = ['102.100.100/', '100/', '102-100-100/', '']
+    for r in range(rows):
+        row = []
+        for col in columns:
+            v = rng.random()
+            if col.startswith('Unnamed'):
+                row.append(None)
+            elif col == 'Name':
+                row.append(ids[int(v * 10) % len(ids)] + str(20000 + r))
+            elif col in ('Lab Number', 'Code', 'Customer', 'Colour', 'Texture', 'Depth'):
+                row.append(col[:3].upper() + str(r % 17))
+            elif v < 0.1:
+                row.append(None)
+            elif v < 0.15:
+                row.append('<0.1')
+            else:
+                row.append(round(v * 50, 2))
+        sheet.append(row)
+    workbook.save(path)
+
+
+def make_archives(folder, samples, megabytes, seed=0):
+    '''
+    Write one SQM run archive per sample and the ids.txt and types.txt files of a data request.
+    Returns the number of members written
+    '''
+    rng = np.random.default_rng(seed)
+    size = max(1, int(megabytes * 1024 * 1024 / len(sqm_types)))
+    members = 0
+    ids = ['SQM' + str(30000 + s) for s in range(samples)]
+    for sample in ids:
+        with tarfile.open(os.path.join(folder, sample + '_SQM.tar.gz'), 'w:gz', compresslevel=6) as tar:
+            for type in sqm_types:
+                #fasta files are sequence, tables are tab separated numbers
+                if 'fasta' in type or 'faa' in type:
+                    data = '\n'.join('>' + str(k) + '\n' + seq for k, seq in enumerate(sequences(rng, size // 301 + 1, 300)))
+                else:
+                    data = '\n'.join('\t'.join(str(x) for x in row) for row in rng.integers(0, 10000, (size // 30 + 1, 6)))
+                info = tarfile.TarInfo(sample + '/results/' + sample + '.' + type)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data.encode()))
+                members += 1
+    with open(os.path.join(folder, 'ids.txt'), 'w') as f:
+        f.write('\n'.join(ids) + '\n')
+    with open(os.path.join(folder, 'types.txt'), 'w') as f:
+        f.write('\n'.join(sqm_types[::3]) + '\n')
+    return members
+
+
+def make_fasta(folder, files, records, seed=0):
+    '''
+    Write sampleID_plateID.fasta files of single line reads, returning the number of records written
+    '''
+    rng = np.random.default_rng(seed)
+    for f in range(files):
+        lengths = rng.integers(250, 300, records)
+        reads = sequences(rng, records, 300)
+        with open(os.path.join(folder, str(40000 + f) + '_PLATE1.fasta'), 'w') as fasta:
+            fasta.write(''.join('>' + str(k) + '\n' + read[:n] + '\n' for k, (read, n) in enumerate(zip(reads, lengths))))
+    return files * records
+
+
+def run(command, cwd, stdin=None):
+    '''
+    Run a command without output, returning its wall time and peak RSS in bytes (None if it can not be measured)
+    '''
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    proc.stdin.write((stdin or '').encode())
+    proc.stdin.close()
+    peak = None
+    if psutil is not None:
+        peak = 0
+        tree = psutil.Process(proc.pid)
+        while proc.poll() is None:
+            try:
+                peak = max(peak, sum(p.memory_info().rss for p in [tree] + tree.children(recursive=True)))
+            except psutil.Error:
+                pass
+            time.sleep(0.02)
+    elif hasattr(os, 'wait4'):
+        pid, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        #ru_maxrss is in kilobytes on linux and bytes on macOS
+        peak = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    proc.wait()
+    seconds = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+    return seconds, peak
+
+
+def make_data(data, args):
+    '''
+    Make the inputs of the chosen tools in the data folder (skipping any already there).
+    Returns the number of rows (or records) of each input
+    '''
+    rows = {}
+    info = os.path.join(data, 'rows.json')
+    if os.path.exists(info):
+        with open(info) as f:
+            rows = json.load(f)
+    long_table = os.path.join(data, 'am_3col.csv')
+    if {'reformat', 'subsample'} & set(args.tools) and 'am_3col' not in rows:
+        print("making AM 3 column table")
+        rows['am_3col'] = make_long_table(long_table, args.samples, args.otus, args.density)
+        with open(long_table, 'rb') as table, gzip.open(long_table + '.gz', 'wb', compresslevel=6) as compressed:
+            shutil.copyfileobj(table, compressed)
+        shuffle_rows(long_table, os.path.join(data, 'am_3col_shuffled.csv'))
+        make_sample_ids(os.path.join(data, 'ids.txt'), args.samples)
+    if 'csbp' in args.tools and 'csbp' not in rows:
+        print("making CSBP workbooks")
+        from convert_CSBP_to_AM import known_soil_cols, known_water_cols
+        os.makedirs(os.path.join(data, 'csbp'), exist_ok=True)
+        for f in range(args.csbp_files):
+            sample_type, columns = [('SOIL', known_soil_cols), ('WATER', known_water_cols)][f % 2]
+            make_csbp(os.path.join(data, 'csbp', sample_type + str(f) + '.xlsx'), columns, args.csbp_rows, seed=f)
+        rows['csbp'] = args.csbp_files * args.csbp_rows
+    if 'utc' in args.tools and 'utc' not in rows:
+        print("making UTC samples")
+        make_samples(os.path.join(data, 'utc.csv'), args.utc_rows, args.sites)
+        rows['utc'] = args.utc_rows
+    if 'metagenome' in args.tools and 'metagenome' not in rows:
+        print("making SQM archives")
+        os.makedirs(os.path.join(data, 'sqm'), exist_ok=True)
+        rows['metagenome'] = make_archives(os.path.join(data, 'sqm'), args.archives, args.archive_mb)
+    if 'fasta' in args.tools and 'fasta' not in rows:
+        print("making fasta files")
+        os.makedirs(os.path.join(data, 'fasta'), exist_ok=True)
+        rows['fasta'] = make_fasta(os.path.join(data, 'fasta'), args.fasta_files, args.fasta_records)
+    with open(info, 'w') as f:
+        json.dump(rows, f)
+    return rows
+
+
+def size(*paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def remove(*patterns):
+    for pattern in patterns:
+        for path in glob.glob(pattern):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def cases(data, out, rows, args):
+    '''
+    Yield (tool, case, command, cwd, stdin, set up, input rows, input bytes) for each run of the chosen tools
+    '''
+    python = sys.executable
+    p = [] if args.processes is None else ['-p', str(args.processes)]
+    long_table = os.path.join(data, 'am_3col.csv')
+    ids = os.path.join(data, 'ids.txt')
+    if 'reformat' in args.tools:
+        for case, mode, fmt in [('standard, csv', '1', 'csv'), ('sparse, csv', '2', 'csv'), ('sparse, npz', '2', 'npz')]:
+            stdin = long_table + '\n' + os.path.join(out, 'wide') + '\n' + mode + '\n' + fmt + '\n'
+            yield 'reformat', case, [python, script('reformat_AM_3col.py')], out, stdin, None, rows['am_3col'], size(long_table)
+    if 'subsample' in args.tools:
+        subsample = [python, script('sub_sample_AM_zotuTABLE_by_sample_id.py'), '-s', ids, '-o', os.path.join(out, 'subset.csv')] + p
+        index = lambda: remove(long_table + '.sidx.npz')
+        yield 'subsample', 'build index', subsample + ['-i', long_table], out, None, index, rows['am_3col'], size(long_table)
+        yield 'subsample', 'indexed', subsample + ['-i', long_table], out, None, None, rows['am_3col'], size(long_table)
+        yield 'subsample', 'stream', subsample + ['-i', long_table, '--stream'], out, None, None, rows['am_3col'], size(long_table)
+        shuffled = os.path.join(data, 'am_3col_shuffled.csv')
+        yield 'subsample', 'shuffled', subsample + ['-i', shuffled], out, None, lambda: remove(shuffled + '.sidx.npz'), rows['am_3col'], size(shuffled)
+        yield 'subsample', 'stream, gzip', subsample + ['-i', long_table + '.gz'], out, None, None, rows['am_3col'], size(long_table + '.gz')
+    if 'csbp' in args.tools:
+        workbooks = sorted(glob.glob(os.path.join(data, 'csbp', '*[0-9].xlsx')))
+        yield 'csbp', 'convert', [python, script('convert_CSBP_to_AM.py'), '--force'] + p + workbooks, out, None, None, rows['csbp'], size(*workbooks)
+    if 'utc' in args.tools:
+        utc, grid = os.path.join(data, 'utc.csv'), os.path.join(out, 'grid')
+        converter = [python, script('convert_local_time_to_UTC.py')]
+        yield 'utc', 'build grid', converter + ['--build-grid', '--grid', grid], out, None, None, 0, 0
+        yield 'utc', 'grid', converter + [utc, '--grid', grid], out, None, None, rows['utc'], size(utc)
+        yield 'utc', 'no grid', converter + [utc, '--no-grid'], out, None, None, rows['utc'], size(utc)
+    if 'metagenome' in args.tools:
+        sqm = os.path.join(data, 'sqm')
+        archives = glob.glob(os.path.join(sqm, '*.tar.gz'))
+        collector = [python, script('metagenomeFileCollector.py')] + p
+        fresh = lambda: remove(os.path.join(sqm, '*_out'), os.path.join(sqm, '*.manifest.json'))
+        yield 'metagenome', 'extract', collector, sqm, None, fresh, rows['metagenome'], size(*archives)
+        yield 'metagenome', 'dry run, indexed', collector + ['--dry-run'], sqm, None, None, rows['metagenome'], size(*archives)
+    if 'fasta' in args.tools:
+        files = sorted(glob.glob(os.path.join(data, 'fasta', '*.fasta')))
+        tagger = [python, script('add_sample_name.py'), '-a', '16S'] + p
+        yield 'fasta', 'tag', tagger + ['-o', os.path.join(out, 'tagged')] + files, out, None, None, rows['fasta'], size(*files)
+        yield 'fasta', 'merge, bgzip', tagger + ['-m', os.path.join(out, 'merged.fasta.gz')] + files, out, None, None, rows['fasta'], size(*files)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the AM scripts on synthetic data")
+    parser.add_argument('--tools', nargs='+', choices=tools, default=tools, help="tools to benchmark (default: all)")
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help="JSON results file (default: benchmark_results.json)")
+    parser.add_argument('--keep', metavar='DIR', help="make the synthetic data in this folder and keep it for later runs")
+    parser.add_argument('--repeat', type=int, default=1, help="runs of each case, the fastest is kept (default: 1)")
+    parser.add_argument('-p', '--processes', type=int, default=None, help="passed on to the tools that run in parallel (default: all cores)")
+    parser.add_argument('--samples', type=int, default=200, help="samples in the AM 3 column table (default: 200)")
+    parser.add_argument('--otus', type=int, default=20000, help="OTUs in the AM 3 column table (default: 20000)")
+    parser.add_argument('--density', type=float, default=0.05, help="average share of the OTUs in each sample (default: 0.05)")
+    parser.add_argument('--csbp-files', type=int, default=8, help="CSBP workbooks, half SOIL and half WATER (default: 8)")
+    parser.add_argument('--csbp-rows', type=int, default=500, help="rows in each CSBP workbook (default: 500)")
+    parser.add_argument('--utc-rows', type=int, default=20000, help="rows of UTC samples (default: 20000)")
+    parser.add_argument('--sites', type=int, default=300, help="distinct sites of the UTC samples (default: 300)")
+    parser.add_argument('--archives', type=int, default=8, help="SQM archives (default: 8)")
+    parser.add_argument('--archive-mb', type=float, default=20, help="uncompressed size of each SQM archive in MB (default: 20)")
+    parser.add_argument('--fasta-files', type=int, default=50, help="fasta files (default: 50)")
+    parser.add_argument('--fasta-records', type=int, default=20000, help="reads in each fasta file (default: 20000)")
+    args = parser.parse_args()
+
+    data = args.keep or tempfile.mkdtemp(prefix='am_benchmark_')
+    os.makedirs(data, exist_ok=True)
+    out = tempfile.mkdtemp(prefix='am_benchmark_out_')
+    try:
+        rows = make_data(data, args)
+        results = []
+        print("\n{:<12}{:<20}{:>10}{:>14}{:>12}{:>14}".format('tool', 'case', 'seconds', 'rows/second', 'MB/second', 'peak RSS (MB)'))
+        for tool, case, command, cwd, stdin, setup, n_rows, n_bytes in cases(data, out, rows, args):
+            best = None
+            for repeat in range(args.repeat):
+                if setup is not None:
+                    setup()
+                try:
+                    seconds, peak = run(command, cwd, stdin)
+                except subprocess.CalledProcessError as e:
+                    print("{:<12}{:<20}failed with exit code {}".format(tool, case, e.returncode))
+                    best = None
+                    break
+                if best is None or seconds < best[0]:
+                    best = (seconds, peak)
+            if best is None:
+                results.append({'tool': tool, 'case': case, 'status': 'failed'})
+                continue
+            seconds, peak = best
+            result = {'tool': tool, 'case': case, 'status': 'ok', 'seconds': round(seconds, 3), 'rows': n_rows, 'bytes': n_bytes,
+                      'rows_per_second': round(n_rows / seconds, 1), 'bytes_per_second': round(n_bytes / seconds, 1), 'peak_rss_bytes': peak}
+            results.append(result)
+            print("{:<12}{:<20}{:>10.2f}{:>14.0f}{:>12.1f}{:>14}".format(tool, case, seconds, result['rows_per_second'],
+                  result['bytes_per_second'] / 1e6, '' if peak is None else round(peak / 1e6)))
+    finally:
+        shutil.rmtree(out, ignore_errors=True)
+        if not args.keep:
+            shutil.rmtree(data, ignore_errors=True)
+
+    settings = {key: value for key, value in vars(args).items() if key not in ('output', 'keep')}
+    report = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'git_commit': git_commit(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'cpus': os.cpu_count(), 'settings': settings, 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("\nresults saved to " + args.output)
@@ -0,0 +1,105 @@
+'''
+A small benchmark of convert_local_time_to_UTC.py
+
+Makes csv files of random samples taken at a few hundred Australian sites and times how long the converter takes on
+them, each run in a new python process.  Cold start is the time to convert a single row, rows/second is worked out
+from the difference between the small and large runs.  Three set ups are compared:
+    legacy  - the original per row conversion (TimezoneFinder and pytz localize for every row)
+    no grid - convert_local_time_to_UTC.py looking up each location in the global time zone data
+    grid    - convert_local_time_to_UTC.py using the precomputed Australian zone grid (built first if needed)
+
+Usage:
+python benchmark_UTC_converter.py [--rows 20000] [--sites 300]
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'convert_local_time_to_UTC.py')
+
+
+def make_samples(path, rows, sites, seed=0):
+    '''
+    Write a csv of samples at random sites in mainland Australia, sampled at midday so no times fall in a DST change
+    '''
+    rng = np.random.default_rng(seed)
+    site_lat = rng.uniform(-38, -12, sites).round(4)
+    site_lon = rng.uniform(115, 153, sites).round(4)
+    site = rng.integers(0, sites, rows)
+    days = pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, 3000, rows), unit='D')
+    df = pd.DataFrame({'Sample_ID': ['102.100.100/' + str(i) for i in range(rows)],
+                       'Date_sampled [YYYY-MM-DD]': days.strftime('%Y-%m-%d'),
+                       'Time_sampled [hh:mm]': '12:00',
+                       'Latitude_(decimal_degrees)': site_lat[site],
+                       'Longitude_(decimal_degrees)': site_lon[site]})
+    df.to_csv(path, index=False)
+
+
+def legacy(input_file):
+    '''
+    The original per row conversion loop of convert_local_time_to_UTC.py
+    '''
+    from timezonefinder import TimezoneFinder
+    import pytz, datetime
+    df = pd.read_csv(input_file)
+    df['Local_Date_Time'] = df['Date_sampled [YYYY-MM-DD]'] + ' ' + df['Time_sampled [hh:mm]']
+    tf = TimezoneFinder()
+    dt_UTC = []
+    dt_zone = []
+    for i in range(df.shape[0]):
+        raw_dat = df.iloc[i].tolist()
+        lat_pos = df.columns.get_loc("Latitude_(decimal_degrees)")
+        lon_pos = df.columns.get_loc("Longitude_(decimal_degrees)")
+        latitude, longitude = raw_dat[lat_pos], raw_dat[lon_pos]
+        zone = tf.timezone_at(lng=longitude, lat=latitude)
+        dt_zone.append(zone)
+        local = pytz.timezone(zone)
+        dt_pos = df.columns.get_loc("Local_Date_Time")
+        naive = datetime.datetime.strptime(raw_dat[dt_pos], "%Y-%m-%d %H:%M")
+        local_dt = local.localize(naive, is_dst=None)
+        dt_UTC.append(local_dt.astimezone(pytz.utc).strftime("%Y-%m-%d %H:%M:%S"))
+    df["UTC"] = dt_UTC
+    df['zone'] = dt_zone
+    df.to_csv(input_file.replace(".csv", "") + "_UTC_converted.csv", index=False)
+
+
+def run(command):
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark convert_local_time_to_UTC.py")
+    parser.add_argument('--rows', type=int, default=20000, help="rows in the large run (default: 20000)")
+    parser.add_argument('--sites', type=int, default=300, help="number of distinct sites (default: 300)")
+    parser.add_argument('--legacy', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.legacy:
+        legacy(args.legacy)
+        raise SystemExit()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        small = os.path.join(tmp, 'small.csv')
+        large = os.path.join(tmp, 'large.csv')
+        grid = os.path.join(tmp, 'grid')
+        make_samples(small, 1, 1)
+        make_samples(large, args.rows, args.sites)
+        print("building zone grid")
+        run([sys.executable, script, '--build-grid', '--grid', grid])
+
+        setups = {'legacy': lambda f: [sys.executable, os.path.abspath(__file__), '--legacy', f],
+                  'no grid': lambda f: [sys.executable, script, f, '--no-grid'],
+                  'grid': lambda f: [sys.executable, script, f, '--grid', grid]}
+        print("\n{:<10}{:>16}{:>16}{:>16}".format('setup', 'cold start (s)', str(args.rows) + ' rows (s)', 'rows/second'))
+        for name, command in setups.items():
+            cold = run(command(small))
+            total = run(command(large))
+            print("{:<10}{:>16.2f}{:>16.2f}{:>16.0f}".format(name, cold, total, args.rows / max(total - cold, 1e-9)))
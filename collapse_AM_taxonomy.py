@@ -0,0 +1,177 @@
+'''
+collapse_AM_taxonomy.py
+
+Sum the OTU counts of each sample by taxonomic rank (e.g., Phylum or Genus), from either a 3 col table downloaded
+from the AM data portal https://data.bioplatforms.com/bpa/otu/ or a wide table made by reformat_AM_3col.py.
+
+Taxa are grouped by their whole lineage down to the rank (Kingdom to Genus for Genus), so two genera of the same name
+in different families are kept apart and OTUs not assigned at the rank are summed into the lineage above it.
+
+    3 col table  - read a block at a time with am_long_table.py (plain or compressed) and only the Sample ID, count
+                   and taxonomy columns.  The lineages of each block are integer coded and the block's counts summed
+                   into a scipy.sparse lineage x sample matrix, so memory holds one block and the (small) collapsed
+                   tables, never the OTU x sample table.  Full portal exports can be collapsed on a 16 GB machine.
+    wide table   - csv, parquet, npz or mtx as written by reformat_AM_3col.py (see am_wide_table.py).  The sparse
+                   OTU x sample matrix is multiplied by a lineage x OTU indicator matrix.  Use npz or parquet for
+                   large tables, a wide csv is read in full
+
+Several ranks can be collapsed in one pass of the table.  For each rank two tables are written, taxa x samples with
+the lineage (Kingdom to the rank) in the last columns, as in the output of reformat_AM_3col.py:
+    <output>_<rank>_absolute.csv  - summed counts (the first column is the lineage joined with ;)
+    <output>_<rank>_relative.csv  - counts divided by the sample's total count
+Requires scipy (`pip install scipy`).  The read and write stages can be logged with --log (see am_instrument.py).
+
+Usage:
+python collapse_AM_taxonomy.py my_download.csv.gz --rank Phylum Genus [-o my_download]
+python collapse_AM_taxonomy.py my_wide_table.npz --rank Family
+'''
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import am_instrument
+import am_long_table
+import am_wide_table
+
+taxonomy = am_long_table.taxonomy
+ranks = taxonomy[2:9]
+
+
+def lineage(rank):
+    #the taxonomy columns from Kingdom down to rank
+    return taxonomy[2:taxonomy.index(rank) + 1]
+
+
+def lineage_codes(frame, codes):
+    '''
+    Integer code of each row's lineage (the categorical columns of frame), adding lineages not yet seen to the codes
+    dictionary.  Missing names are ''
+    '''
+    rows = np.column_stack([frame[col].cat.codes.to_numpy() for col in frame.columns])
+    unique, inverse = np.unique(rows, axis=0, return_inverse=True)
+    names = [frame[col].cat.categories for col in frame.columns]
+    lookup = np.array([codes.setdefault(tuple(names[k][c] if c >= 0 else '' for k, c in enumerate(row)), len(codes))
+                       for row in unique], dtype=np.int64)
+    return lookup[inverse.ravel()]
+
+
+def collapse_long(infile, collapse_ranks):
+    '''
+    Collapse a 3 col table by each rank in one pass.  Rows with no Sample ID are left out (with a warning).
+    Returns {rank: (lineage x sample matrix, lineages)} and the Sample IDs, all in sorted order
+    '''
+    from scipy import sparse
+
+    columns = ['Sample ID', 'OTU Count'] + lineage(max(collapse_ranks, key=taxonomy.index))
+    sample_codes = {}
+    codes = {rank: {} for rank in collapse_ranks}
+    sums = {rank: None for rank in collapse_ranks}
+    no_sample = 0
+    with am_instrument.stage('read', file=infile) as read:
+        for chunk in am_long_table.iter_table(infile, columns=columns):
+            read.add(rows=len(chunk))
+            no_sample += chunk['Sample ID'].isna().sum()
+            chunk = chunk[chunk['Sample ID'].notna()]
+            if not len(chunk):
+                continue
+            cols = am_long_table.encode(chunk['Sample ID'], sample_codes)
+            counts = chunk['OTU Count'].to_numpy(dtype=np.int64)
+            for rank in collapse_ranks:
+                rows = lineage_codes(chunk[lineage(rank)], codes[rank])
+                #duplicate lineage/sample entries of the block are summed when it is made
+                block = sparse.csr_matrix((counts, (rows, cols)), shape=(len(codes[rank]), len(sample_codes)))
+                if sums[rank] is None:
+                    sums[rank] = block
+                else:
+                    sums[rank].resize(block.shape)
+                    sums[rank] = sums[rank] + block
+        read.add(bytes=os.path.getsize(infile))
+    if no_sample:
+        print("WARNING: " + str(no_sample) + " rows of " + infile + " have no Sample ID and were left out")
+
+    samples = pd.Index(list(sample_codes), name='Sample ID')
+    sample_order = samples.argsort()
+    collapsed = {}
+    for rank in collapse_ranks:
+        lineages = list(codes[rank])
+        order = sorted(range(len(lineages)), key=lineages.__getitem__)
+        table = sums[rank] if sums[rank] is not None else sparse.csr_matrix((0, 0), dtype=np.int64)
+        table.resize((len(lineages), len(samples)))
+        collapsed[rank] = (table[order][:, sample_order], [lineages[i] for i in order])
+    return collapsed, samples[sample_order]
+
+
+def collapse_wide(path, collapse_ranks):
+    '''
+    Collapse a wide table by each rank, multiplying its sparse matrix by lineage x OTU indicator matrices.
+    Returns the same as collapse_long()
+    '''
+    from scipy import sparse
+
+    with am_instrument.stage('read', file=path) as read:
+        tableW, otus, samples, taxL1 = am_wide_table.load_wide_table(path)
+        read.add(rows=len(otus))
+    taxL1 = taxL1.reindex(otus)
+    collapsed = {}
+    for rank in collapse_ranks:
+        names = taxL1[lineage(rank)].astype(object).where(taxL1[lineage(rank)].notna(), '')
+        lineages = sorted(set(names.itertuples(index=False, name=None)))
+        codes = {name: i for i, name in enumerate(lineages)}
+        rows = np.array([codes[name] for name in names.itertuples(index=False, name=None)], dtype=np.int64)
+        indicator = sparse.csr_matrix((np.ones(len(rows)), (rows, np.arange(len(rows)))), shape=(len(lineages), len(rows)))
+        collapsed[rank] = ((indicator @ tableW).tocsr(), lineages)
+    return collapsed, samples
+
+
+def write_collapsed(output, rank, table, lineages, samples):
+    '''
+    Write the absolute and relative abundance tables of one rank, returning the files written
+    '''
+    from scipy import sparse
+
+    totals = np.asarray(table.sum(axis=0), dtype=np.float64).ravel()
+    scale = np.divide(1, totals, out=np.zeros_like(totals), where=totals > 0)
+    if table.dtype.kind == 'f' and np.all(np.mod(table.data, 1) == 0):
+        table = table.astype(np.int64)
+    taxa = pd.DataFrame(lineages, columns=lineage(rank))
+    taxa.index = pd.Index([';'.join(name) for name in lineages], name='Lineage')
+    files = []
+    for kind, matrix in (('absolute', table), ('relative', (table @ sparse.diags(scale)).tocsr())):
+        path = output + '_' + rank + '_' + kind + '.csv'
+        with open(path + '.tmp', 'w', newline='') as out:
+            for start, end in am_wide_table.row_blocks(len(lineages), len(samples)):
+                block = pd.DataFrame(matrix[start:end].toarray(), index=taxa.index[start:end], columns=samples)
+                pd.concat([block, taxa.iloc[start:end]], axis=1).to_csv(out, header=(start == 0))
+            if not len(lineages):
+                pd.DataFrame(columns=list(samples) + list(taxa.columns), index=taxa.index).to_csv(out)
+        os.replace(path + '.tmp', path)
+        files.append(path)
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sum OTU counts by taxonomic rank for each sample")
+    parser.add_argument('input', help="3 col table (.csv, .csv.gz, .csv.bgz or .csv.zst) or wide table from reformat_AM_3col.py (.csv, .parquet, .npz, .mtx)")
+    parser.add_argument('-r', '--rank', nargs='+', required=True, choices=ranks, help="rank(s) to collapse to")
+    parser.add_argument('-o', '--output', help="start of the output file names (default: the input name without extensions)")
+    am_instrument.add_arguments(parser)
+    args = parser.parse_args()
+    am_instrument.configure_from_args(args)
+
+    output = args.output or os.path.basename(args.input).split('.')[0]
+    collapse_ranks = list(dict.fromkeys(args.rank))
+    wide = os.path.splitext(args.input)[1] in ('.parquet', '.npz', '.mtx') or not am_long_table.check_header(args.input)
+    print("Reading " + args.input + (" (wide table)" if wide else " (3 col table)"))
+    if wide:
+        collapsed, samples = collapse_wide(args.input, collapse_ranks)
+    else:
+        collapsed, samples = collapse_long(args.input, collapse_ranks)
+
+    for rank in collapse_ranks:
+        table, lineages = collapsed[rank]
+        with am_instrument.stage('write', rank=rank) as write:
+            files = write_collapsed(output, rank, table, lineages, samples)
+            write.add(rows=len(lineages))
+        print(rank + ": " + str(len(lineages)) + " taxa in " + str(len(samples)) + " samples written to " + ", ".join(files))
+    am_instrument.event('finished', file=args.input)
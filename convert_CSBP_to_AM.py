@@ -10,6 +10,17 @@ python convert_CSBP_to_AM.py
 
     > Follow the instructions issued by the script and enter the required path/filename information at the prompts 
 
+python convert_CSBP_to_AM.py [-p 8] [--force] <files, folders or wildcards>
+
+    > Batch mode, no prompts.  Files are converted in parallel (one per core unless -p is given).  Files whose
+      output is newer than the file are skipped unless --force is given, and a summary table is printed at the end
+
+The read, convert and save stages of each file can be timed and logged with --log, and overall progress shown with
+--progress (see am_instrument.py)
+
+The first four rows of each workbook are checked first (a read only pass that stops there) so that non-CSBP files are
+skipped without being loaded, CSBP files are then read in full with pandas.  The script's own *_UPDATE.xlsx outputs are never taken as input files.
+
 This script has been tested using on:
     - windows powershell 7 (x64), python version 3.9.13
     - macOS 10.15.7, python version 3.7.3
@@ -22,6 +33,10 @@ import pandas as pd
 import numpy as np
 import glob
 import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import am_instrument
 
 def formatIDs(df):
     #make sure sample_id column is set as a string (if IDs are short form then it may be a number)
@@ -32,183 +47,246 @@ def formatIDs(df):
     badIDs = ['100/','102-100-100/','102.100.100.','102.100..100']
     for ele in badIDs:
         df['sample_id'] = df['sample_id'].str.replace('^' + ele, id_prefix, regex=True)
-    #Reset the ID list incase there were any changes made
-    IDs = df['sample_id'].tolist()
-    for i in df.index:
-        ID = df.loc[i, 'sample_id']
-        #If the correct prefix is not present we will add it, and the ID flag for manual checking
-        if id_prefix not in ID:
-            fixedID = id_prefix + ID
-            df.loc[i, 'sample_id'] = fixedID
-
-print("\t*** CSBP to Australian Microbiome (AM) metadata converter ***\n")
-print("This script will convert SOIL and Water CSBP excel files to a format compliant with the AM Database.")
-print("Before you start, make sure:")
-print("\t1) The CSBP sheet retains its original formatting (No deleted or renamed columns)")
-print("\t2) All non-AM samples are deleted from the sheet\n")
-print("The script will: ")
-print("\t1) Convert CSBP units to AM units for the following:")
-print("\t\tWater - Ammonium Nitrogen (mg/L N) to ammonium in umol/l N")
-print("\t\tWater - Nitrate Nitrogen (mg/L N) to nitrate_nitrite in umol/l N")
-print("\t\tWater - Conductivity (dS/m) to conductivity_aqueous in S/m")
-print("\t2) Add standard AM method numbers for each analysis (If using a non-standard AM/CSBP analysis do not use this script)")
-print("\t3) Save your file(s) as a AM *_UPDATE.xlsx file")
-print("\n NOTE: This script will delete DEPTH values entered on the CSBP sheet. Ensure this information is included in your AM submission sheet.")
-
-print("\n Output files will be saved to the same path as the input files")
-print(" Do you want to convert multiple files or a single file?")
-print("\tEnter 1 for multiple files (non-CSBP sheets will be ignored)")
-print("\tEnter 2 for a single file")
-user_choice =''
-user_choice = input("Enter 1 or 2: ")
-
-if user_choice == '1':
-    filePath = input("Enter the path where files are located (hit enter if in the current directory): ")
-    suffix = "*.xl*"
-    search_files = os.path.join(filePath,suffix)
-    print(search_files)
-
-if user_choice == '2':
-    search_files = input("Drag and drop the file to be converted or enter its path/name: ")
-    #dragged and dropped paths may be in quotes or have trailing linebreaks/whitespace, so we will strip them
-    search_files = search_files.replace("\"",'').rstrip()
-    os.path.normpath(search_files)
-    print(search_files)
-filenames = glob.glob(search_files)
+    #If the correct prefix is not present we will add it, and the ID flag for manual checking
+    no_prefix = ~df['sample_id'].str.contains(id_prefix, regex=False)
+    df.loc[no_prefix, 'sample_id'] = id_prefix + df.loc[no_prefix, 'sample_id']
+
+def convertUnits(values, multiplier, divisor):
+    #convert numeric values, censored values (e.g., "<0.1") and nulls are kept unchanged
+    values = values.astype(object)
+    numeric = pd.to_numeric(values, errors='coerce')
+    keep = values.isna() | values.astype(str).str.contains('[<>]') | numeric.isna()
+    return values.where(keep, (numeric * multiplier) / divisor)
 
 #define known header format of CSBP Soil and water analysis files. Note these names are stripped of trailing whitespace
 known_water_cols = ['Lab Number', 'Unnamed: 1', 'Name', 'Unnamed: 3', 'Code', 'Customer', 'Ammonium Nitrogen', 'Nitrate Nitrogen', 'Unnamed: 8', 'Boron', 'Sodium', 'Magnesium', 'Phosphorous', 'Sulfur', 'Chloride', 'Potassium', 'Calcium', 'Manganese', 'Iron', 'Copper', 'Zinc', 'Bicarb', 'Carbonate', 'Conductivity', 'pH']
 known_soil_cols = ['Lab Number', 'Unnamed: 1', 'Name', 'Unnamed: 3', 'Code', 'Customer', 'Depth', 'Colour', 'Unnamed: 8', 'Gravel', 'Texture', 'Ammonium Nitrogen', 'Nitrate Nitrogen', 'Phosphorus Colwell', 'Potassium Colwell', 'Sulfur', 'Organic Carbon', 'Conductivity', 'pH Level (CaCl2)', 'pH Level (H2O)', 'DTPA Copper', 'DTPA Iron', 'DTPA Manganese', 'DTPA Zinc', 'Exc. Aluminium', 'Exc. Calcium', 'Exc. Magnesium', 'Exc. Potassium', 'Exc. Sodium', 'Boron Hot CaCl2', 'Total Nitrogen', '% Clay', '% Course Sand', '% Fine Sand', '% Sand', '% Silt']
 
-for filename in filenames:
-    #set file identifier flags for incoming file
-    water_file = False
-    soil_file = False
-    #check if csbp headers are present if not we will skip the file, if it is we will read it in gain skipping them
-    data = pd.read_excel(filename)
-    if set(['Customer']).issubset(data.columns):
-        #skip the first 3 rows of the CSPB header
-        data = pd.read_excel(filename, skiprows=3,dtype='str')
-        #drop row at index 0 as it contains units
-        data = data.drop([data.index[0]]).reset_index(drop=True)
-        #remove any trailing whitespace from the incoming column names
-        data.columns = data.columns.str.rstrip()
-        #list incoming columns to check if the incoming file meets known CSBP SOIL or Water analysis files and format appropriately      
-        incoming_cols = data.columns.tolist()
+def read_header(filename):
+    '''
+    Read the first four rows of a workbook (read only, without loading the whole sheet).
+    Returns the values of the first row and the CSBP column names from the fourth row, named and stripped
+    of trailing whitespace as pandas.read_excel(skiprows=3) would name them
+    '''
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        from openpyxl import load_workbook
+        workbook = load_workbook(filename, read_only=True)
+        try:
+            sheet = workbook.worksheets[0]
+            #read only sheets trust the size stored in the file, which some writers get wrong (pandas resets it too)
+            sheet.reset_dimensions()
+            rows = [list(row) for row in sheet.iter_rows(max_row=4, values_only=True)]
+        finally:
+            workbook.close()
+    else:
+        rows = pd.read_excel(filename, header=None, nrows=4).values.tolist()
+    rows = [[None if pd.isna(value) else value for value in row] for row in rows] + [[]] * (4 - len(rows))
+    names = ['Unnamed: ' + str(i) if value is None else str(value).rstrip() for i, value in enumerate(rows[3])]
+    return rows[0], names
+
+def find_files(paths):
+    '''
+    Expand files, folders and wildcards to a list of workbooks, leaving out this script's own *_UPDATE.xlsx outputs
+    and excel lock files
+    '''
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            path = os.path.join(path, "*.xl*")
+        filenames.extend(sorted(glob.glob(path)))
+    return [f for f in filenames if not f.endswith('_UPDATE.xlsx') and not os.path.basename(f).startswith('~$')]
+
+def print_summary(results):
+    widths = [max(len(str(r[key])) for r in results + [{key: key}]) for key in ('file', 'type', 'status', 'rows', 'seconds')]
+    print()
+    for r in [{'file': 'file', 'type': 'type', 'status': 'status', 'rows': 'rows', 'seconds': 'seconds'}] + results:
+        print("  ".join(str(r[key]).ljust(width) for key, width in zip(('file', 'type', 'status', 'rows', 'seconds'), widths)))
+    converted = sum(r['status'] == 'converted' for r in results)
+    failed = sum(r['status'].startswith('failed') for r in results)
+    print("\n" + str(converted) + " of " + str(len(results)) + " files converted" + (", " + str(failed) + " failed" if failed else ""))
+
+def convert_file(filename, force=False):
+    '''
+    Convert a single CSBP workbook, returning a summary of what was done.  A workbook that can not be read or
+    converted is reported as failed rather than stopping the other files
+    '''
+    start = time.time()
+    result = {'file': filename, 'type': '', 'status': '', 'rows': '', 'seconds': ''}
+    try:
+        return convert_workbook(filename, result, start, force)
+    except Exception as e:
+        print("WARNING: " + filename + " could not be converted: " + type(e).__name__ + ": " + str(e))
+        result.update(status='failed: ' + type(e).__name__ + ': ' + str(e), seconds=round(time.time() - start, 2))
+        return result
+
+def convert_workbook(filename, result, start, force=False):
+    #set file identifier flags for incoming file from the header rows, without reading the whole sheet
+    first_row, incoming_cols = read_header(filename)
+    water_file = set(known_water_cols).issubset(incoming_cols)
+    soil_file = set(known_soil_cols).issubset(incoming_cols)
+    #check if csbp headers are present if not we will skip the file, if it is we will read it in skipping them
+    if 'Customer' in first_row:
+        #if no matches we will throw a warning to advise and move on
+        if water_file == False and soil_file == False:
+            print("WARNING: " + filename + " does not appear to be a properly formatted CSBP water or soil analysis file")
+            result['status'] = 'not a CSBP SOIL or WATER file'
+            return result
+        sample_type = "SOIL" if soil_file else "WATER"
+        #make a output filename
+        file, file_extension = os.path.splitext(filename)
+        outfile=filename.replace(file_extension, "_AM_" + sample_type + "_format_UPDATE.xlsx")
+        result['type'] = sample_type
+        #skip files that have already been converted since they last changed
+        if not force and os.path.exists(outfile) and os.path.getmtime(outfile) >= os.path.getmtime(filename):
+            result['status'] = 'up to date'
+            return result
+
+        with am_instrument.stage('read', file=filename) as read:
+            #skip the first 3 rows of the CSPB header
+            data = pd.read_excel(filename, skiprows=3,dtype='str')
+            #drop row at index 0 as it contains units
+            data = data.drop([data.index[0]]).reset_index(drop=True)
+            #remove any trailing whitespace from the incoming column names
+            data.columns = data.columns.str.rstrip()
+            read.add(rows=len(data), bytes=os.path.getsize(filename))
         
-        #Lets do some preformatting
-        #convert txt nulls to numpy nan - we will drop any extra columns containing all nan
-        data.replace(['None', 'nan'], np.nan, inplace=True)
-        data.dropna(axis=1, how='all', inplace=True)
-        #Drop known unused columns
-        drops= ['Lab Number', 'Code','Customer']
-        data.drop(drops,axis=1,inplace=True)
+        with am_instrument.stage('convert', file=filename):
+            #Lets do some preformatting
+            #convert txt nulls to numpy nan - we will drop any extra columns containing all nan
+            data.replace(['None', 'nan'], np.nan, inplace=True)
+            data.dropna(axis=1, how='all', inplace=True)
+            #Drop known unused columns
+            drops= ['Lab Number', 'Code','Customer']
+            data.drop(drops,axis=1,inplace=True)
         
-        #Check if its a water or soil file and process appropriately
-        ############ WATER Files ############
-        if len(set(known_water_cols).difference(set(incoming_cols))) > 0:
-            #set a flag and move on 
-            water_file = False
-        else:
-            print("\nProcessing water file: " + filename)
-            water_file = True
-            #make a output filename
-            file, file_extension = os.path.splitext(filename)
-            outfile=filename.replace(file_extension, "_AM_WATER_format_UPDATE.xlsx")
-            print("File will be saved as: " + outfile)
+            #Check if its a water or soil file and process appropriately
+            ############ WATER Files ############
+            if water_file and not soil_file:
+                print("\nProcessing water file: " + filename)
+                print("File will be saved as: " + outfile)
             
-            #define Water columns that need to be converted to AM units
-            convert_cols = ['Ammonium Nitrogen','Nitrate Nitrogen','Conductivity']
-            #define molecular weights
-            N_mw = 14.006720
-            for col in convert_cols:
-                print("Converting: " + col)
-                for i in data.index:
-                    if 'Ammonium Nitrogen' == col:
-                        inVal = data.loc[i,col]
-                        if "<" in str(inVal) or ">" in str(inVal) or pd.isnull(inVal):
-                            data.loc[i,'ammonium'] = data.loc[i,col]
-                        else:
-                            data.loc[i,'ammonium'] = (float(inVal)*1000)/N_mw
-                    if 'Nitrate Nitrogen' == col:
-                        inVal = data.loc[i,col]
-                        if "<" in str(inVal) or ">" in str(inVal) or pd.isnull(inVal):
-                            data.loc[i,'nitrate_nitrite'] = data.loc[i,col]
-                        else:
-                            data.loc[i,'nitrate_nitrite'] = (float(inVal)*1000)/N_mw
-                    if 'Conductivity' == col:
-                        inVal = data.loc[i,col]
-                        if "<" in str(inVal) or ">" in str(inVal) or pd.isnull(inVal):
-                            data.loc[i,'conductivity_aqueous'] = data.loc[i,col]
-                        else:
-                            data.loc[i,'conductivity_aqueous'] = float(inVal)/10
-            #drop the columns once they have been converted
-            data.drop(convert_cols, axis=1, inplace=True)
+                #define Water columns that need to be converted to AM units, the AM column name and the conversion factors
+                #define molecular weights
+                N_mw = 14.006720
+                conversions = {'Ammonium Nitrogen': ('ammonium', 1000, N_mw),
+                               'Nitrate Nitrogen': ('nitrate_nitrite', 1000, N_mw),
+                               'Conductivity': ('conductivity_aqueous', 1, 10)}
+                convert_cols = list(conversions)
+                for col, (am_col, multiplier, divisor) in conversions.items():
+                    print("Converting: " + col)
+                    data[am_col] = convertUnits(data[col], multiplier, divisor)
+                #drop the columns once they have been converted
+                data.drop(convert_cols, axis=1, inplace=True)
             
-            #Convert the headers to AM format fields using the dictionary of known headings
-            column_dictionary = {'Name':'sample_id','ammonium':'ammonium','nitrate_nitrite':'nitrate_nitrite','conductivity_aqueous':'conductivity_aqueous','Boron':'icp_te_boron','Sodium':'sodium','Magnesium':'magnesium','Phosphorous':'icp_te_phosphorus','Sulfur':'icp_te_sulfur','Chloride':'chloride','Potassium':'potassium','Calcium':'icp_te_calcium','Manganese':'icp_te_manganese','Iron':'icp_te_iron','Copper':'icp_te_copper','Zinc':'icp_te_zinc','Bicarb':'bicarbonate','Carbonate':'carbonate','pH':'ph'}
-            data.columns = data.columns.to_series().map(column_dictionary)
+                #Convert the headers to AM format fields using the dictionary of known headings
+                column_dictionary = {'Name':'sample_id','ammonium':'ammonium','nitrate_nitrite':'nitrate_nitrite','conductivity_aqueous':'conductivity_aqueous','Boron':'icp_te_boron','Sodium':'sodium','Magnesium':'magnesium','Phosphorous':'icp_te_phosphorus','Sulfur':'icp_te_sulfur','Chloride':'chloride','Potassium':'potassium','Calcium':'icp_te_calcium','Manganese':'icp_te_manganese','Iron':'icp_te_iron','Copper':'icp_te_copper','Zinc':'icp_te_zinc','Bicarb':'bicarbonate','Carbonate':'carbonate','pH':'ph'}
+                data.columns = data.columns.to_series().map(column_dictionary)
             
-            #Define the ouput columns and fill for CSBP water methods columns
-            column_order = ['sample_id']
-            analysis_columns = ['ammonium', 'bicarbonate', 'carbonate', 'chloride', 'conductivity_aqueous', 'icp_te_boron', 'icp_te_calcium', 'icp_te_copper', 'icp_te_iron', 'icp_te_manganese', 'icp_te_phosphorus', 'icp_te_sulfur', 'icp_te_zinc', 'magnesium', 'nitrate_nitrite', 'ph', 'potassium', 'sodium']
-            method_number = "meth_2.1"
+                #Define the ouput columns and fill for CSBP water methods columns
+                column_order = ['sample_id']
+                analysis_columns = ['ammonium', 'bicarbonate', 'carbonate', 'chloride', 'conductivity_aqueous', 'icp_te_boron', 'icp_te_calcium', 'icp_te_copper', 'icp_te_iron', 'icp_te_manganese', 'icp_te_phosphorus', 'icp_te_sulfur', 'icp_te_zinc', 'magnesium', 'nitrate_nitrite', 'ph', 'potassium', 'sodium']
+                method_number = "meth_2.1"
         
-        ############ SOIL Files ############
-        if len(set(known_soil_cols).difference(set(incoming_cols))) > 0:
-            #set a flag and move on 
-            soil_file = False
-        else:
-            print("\nProcessing soil file: " + filename)
-            soil_file = True
-            #make output filename
-            file, file_extension = os.path.splitext(filename)
-            outfile=filename.replace(file_extension, "_AM_SOIL_format_UPDATE.xlsx")
-            print("File will be saved as: " + outfile)
+            ############ SOIL Files ############
+            if soil_file:
+                print("\nProcessing soil file: " + filename)
+                print("File will be saved as: " + outfile)
             
-            #Convert the headers to AM format fields using the dictionary of known headings. column headers stripped of trailing whitespace
-            column_dictionary = {'Name': 'sample_id', 'Depth': 'depth', 'Colour': 'color', 'Gravel': 'gravel', 'Texture': 'texture', 'Ammonium Nitrogen': 'ammonium_nitrogen_wt', 'Nitrate Nitrogen': 'nitrate_nitrogen', 'Phosphorus Colwell': 'phosphorus_colwell', 'Potassium Colwell': 'potassium_colwell', 'Sulfur': 'sulphur', 'Organic Carbon': 'organic_carbon', 'Conductivity': 'conductivity', 'pH Level (CaCl2)': 'ph', 'pH Level (H2O)': 'ph_solid_h2o', 'DTPA Copper': 'dtpa_copper', 'DTPA Iron': 'dtpa_iron', 'DTPA Manganese': 'dtpa_manganese', 'DTPA Zinc': 'dtpa_zinc', 'Exc. Aluminium': 'exc_aluminium', 'Exc. Calcium': 'exc_calcium', 'Exc. Magnesium': 'exc_magnesium', 'Exc. Potassium': 'exc_potassium', 'Exc. Sodium': 'exc_sodium', 'Boron Hot CaCl2': 'boron_hot_cacl2', 'Total Nitrogen': 'total_nitrogen', '% Clay': 'clay', '% Course Sand': 'coarse_sand', '% Fine Sand': 'fine_sand', '% Sand': 'sand', '% Silt': 'silt'}
-            data.columns = data.columns.to_series().map(column_dictionary)
+                #Convert the headers to AM format fields using the dictionary of known headings. column headers stripped of trailing whitespace
+                column_dictionary = {'Name': 'sample_id', 'Depth': 'depth', 'Colour': 'color', 'Gravel': 'gravel', 'Texture': 'texture', 'Ammonium Nitrogen': 'ammonium_nitrogen_wt', 'Nitrate Nitrogen': 'nitrate_nitrogen', 'Phosphorus Colwell': 'phosphorus_colwell', 'Potassium Colwell': 'potassium_colwell', 'Sulfur': 'sulphur', 'Organic Carbon': 'organic_carbon', 'Conductivity': 'conductivity', 'pH Level (CaCl2)': 'ph', 'pH Level (H2O)': 'ph_solid_h2o', 'DTPA Copper': 'dtpa_copper', 'DTPA Iron': 'dtpa_iron', 'DTPA Manganese': 'dtpa_manganese', 'DTPA Zinc': 'dtpa_zinc', 'Exc. Aluminium': 'exc_aluminium', 'Exc. Calcium': 'exc_calcium', 'Exc. Magnesium': 'exc_magnesium', 'Exc. Potassium': 'exc_potassium', 'Exc. Sodium': 'exc_sodium', 'Boron Hot CaCl2': 'boron_hot_cacl2', 'Total Nitrogen': 'total_nitrogen', '% Clay': 'clay', '% Course Sand': 'coarse_sand', '% Fine Sand': 'fine_sand', '% Sand': 'sand', '% Silt': 'silt'}
+                data.columns = data.columns.to_series().map(column_dictionary)
             
-            #Drop the depth column as it should be provided on the AM submission sheet
-            data.drop(['depth'], axis=1, inplace=True)
+                #Drop the depth column as it should be provided on the AM submission sheet
+                data.drop(['depth'], axis=1, inplace=True)
             
-            #Define the ouput columns and fill for CSBP SOIL methods columns
-            column_order = ['sample_id']
-            analysis_columns = ['color', 'gravel', 'texture', 'ammonium_nitrogen_wt', 'nitrate_nitrogen', 'phosphorus_colwell', 'potassium_colwell', 'sulphur', 'organic_carbon', 'conductivity', 'ph', 'ph_solid_h2o', 'dtpa_copper', 'dtpa_iron', 'dtpa_manganese', 'dtpa_zinc', 'exc_aluminium', 'exc_calcium', 'exc_magnesium', 'exc_potassium', 'exc_sodium', 'boron_hot_cacl2', 'total_nitrogen', 'clay', 'coarse_sand', 'fine_sand', 'sand', 'silt']
-            method_number = "meth_2.1"
-        #if no matches we will throw a warning to advise and move on
-        if water_file == False and soil_file == False:
-            print("WARNING: " + filename + " does not appear to be a properly formatted CSBP water or soil analysis file")
-            continue
-        
-        ######### Common mods to both Soil and Water #########
-        #remove any badly formatted IDs and replace with long format ID
-        formatIDs(data)
-
-        #Fill analysis columns based on the specific Soil or Water lists
-        for col in analysis_columns:
-            meth_col = col + "_meth"
-            if col == "water_content":
-                meth_col = water_content_soil_meth
-            data[meth_col] = np.nan
-            #append the incoming columns to the column order list so we can order the dataframe
-            column_order.append(col)
-            column_order.append(meth_col)
-            #populate the method number if the analysis isnt null
-            for i in data.index:
-                if (pd.isna(data.loc[i,col])):
-                    print(col, i)
-                    continue
-                else:
-                    data.loc[i,meth_col] = method_number
-
-        data = data[column_order]
+                #Define the ouput columns and fill for CSBP SOIL methods columns
+                column_order = ['sample_id']
+                analysis_columns = ['color', 'gravel', 'texture', 'ammonium_nitrogen_wt', 'nitrate_nitrogen', 'phosphorus_colwell', 'potassium_colwell', 'sulphur', 'organic_carbon', 'conductivity', 'ph', 'ph_solid_h2o', 'dtpa_copper', 'dtpa_iron', 'dtpa_manganese', 'dtpa_zinc', 'exc_aluminium', 'exc_calcium', 'exc_magnesium', 'exc_potassium', 'exc_sodium', 'boron_hot_cacl2', 'total_nitrogen', 'clay', 'coarse_sand', 'fine_sand', 'sand', 'silt']
+                method_number = "meth_2.1"
+
+            ######### Common mods to both Soil and Water #########
+            #remove any badly formatted IDs and replace with long format ID
+            formatIDs(data)
+
+            #Fill analysis columns based on the specific Soil or Water lists
+            for col in analysis_columns:
+                meth_col = col + "_meth"
+                if col == "water_content":
+                    meth_col = water_content_soil_meth
+                #append the incoming columns to the column order list so we can order the dataframe
+                column_order.append(col)
+                column_order.append(meth_col)
+                #populate the method number if the analysis isnt null
+                data[meth_col] = np.where(data[col].notna(), np.array(method_number, dtype=object), np.nan)
+
+            data = data[column_order]
         #save the file 
-        data.to_excel(outfile, index=False)
+        with am_instrument.stage('save', file=outfile) as save:
+            data.to_excel(outfile, index=False)
+            save.add(rows=len(data))
+        result.update(status='converted', rows=len(data), seconds=round(time.time() - start, 2))
     else:
         print()
         print(filename + " Not in CSBP format")
-        continue  
+        result['status'] = 'not in CSBP format'
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert CSBP SOIL and WATER analysis sheets to AM format. Prompts for the files if none are given.")
+    parser.add_argument('paths', nargs='*', help="CSBP workbooks, folders of workbooks or wildcards")
+    parser.add_argument('-p', '--processes', type=int, default=None, help="number of files to convert at once (default: all cores)")
+    parser.add_argument('--force', action='store_true', help="convert files even if their output is up to date")
+    am_instrument.add_arguments(parser)
+    args = parser.parse_args()
+    am_instrument.configure_from_args(args)
+
+    if args.paths:
+        filenames = find_files(args.paths)
+    else:
+        print("\t*** CSBP to Australian Microbiome (AM) metadata converter ***\n")
+        print("This script will convert SOIL and Water CSBP excel files to a format compliant with the AM Database.")
+        print("Before you start, make sure:")
+        print("\t1) The CSBP sheet retains its original formatting (No deleted or renamed columns)")
+        print("\t2) All non-AM samples are deleted from the sheet\n")
+        print("The script will: ")
+        print("\t1) Convert CSBP units to AM units for the following:")
+        print("\t\tWater - Ammonium Nitrogen (mg/L N) to ammonium in umol/l N")
+        print("\t\tWater - Nitrate Nitrogen (mg/L N) to nitrate_nitrite in umol/l N")
+        print("\t\tWater - Conductivity (dS/m) to conductivity_aqueous in S/m")
+        print("\t2) Add standard AM method numbers for each analysis (If using a non-standard AM/CSBP analysis do not use this script)")
+        print("\t3) Save your file(s) as a AM *_UPDATE.xlsx file")
+        print("\n NOTE: This script will delete DEPTH values entered on the CSBP sheet. Ensure this information is included in your AM submission sheet.")
+
+        print("\n Output files will be saved to the same path as the input files")
+        print(" Do you want to convert multiple files or a single file?")
+        print("\tEnter 1 for multiple files (non-CSBP sheets will be ignored)")
+        print("\tEnter 2 for a single file")
+        user_choice =''
+        user_choice = input("Enter 1 or 2: ")
+
+        if user_choice == '1':
+            filePath = input("Enter the path where files are located (hit enter if in the current directory): ")
+            suffix = "*.xl*"
+            search_files = os.path.join(filePath,suffix)
+            print(search_files)
+
+        if user_choice == '2':
+            search_files = input("Drag and drop the file to be converted or enter its path/name: ")
+            #dragged and dropped paths may be in quotes or have trailing linebreaks/whitespace, so we will strip them
+            search_files = search_files.replace("\"",'').rstrip()
+            os.path.normpath(search_files)
+            print(search_files)
+        filenames = find_files([search_files])
+
+    results = []
+    with ProcessPoolExecutor(max_workers=args.processes, initializer=am_instrument.configure, initargs=am_instrument.worker_settings()) as pool, \
+            am_instrument.stage('convert files', total=len(filenames), unit='files') as progress:
+        for result in pool.map(convert_file, filenames, [args.force] * len(filenames)):
+            results.append(result)
+            progress.add(files=1)
+    if results:
+        print_summary(results)
 
-print("Finished converting files - Please check the converted files manually")
+    print("Finished converting files - Please check the converted files manually")
+    am_instrument.event('finished', files=len(filenames))
@@ -12,6 +12,8 @@ Sample_ID,Date_sampled [YYYY-MM-DD],Time_sampled [hh:mm],Latitude_(decimal_degre
 
 2) Upon running the script, the user will be prompted to enter the path and name of the csv file to be converted.
     The script will advise the user of the output file name and path.
+    The file can also be given on the command line to run without prompts:
+        python convert_local_time_to_UTC.py my_samples.csv
  
 5) The script will generate: 
     UTC_Date_sampled_(YYYY-MM-DD) = UTC date format that can be submitted to the AM
@@ -22,6 +24,22 @@ Sample_ID,Date_sampled [YYYY-MM-DD],Time_sampled [hh:mm],Latitude_(decimal_degre
 
 Note: If opening the output file in excel, it may automatically reformat the date stamp formats.
 
+Time zones are looked up once per unique latitude/longitude pair and the times of each zone are converted together.
+Local times that are ambiguous or do not exist because of a daylight saving change, and locations without a time zone,
+are listed at the end of the run and left blank in the UTC columns.
+
+Zone lookups can be kept between runs by giving a cache file (created if it does not exist), e.g.:
+    python convert_local_time_to_UTC.py --zone-cache timezone_cache.json
+
+Faster start up for Australian samples:
+    python convert_local_time_to_UTC.py --build-grid
+builds (once, takes under a minute) a grid of the time zones of Australia, its surrounding oceans and the Australian Antarctic
+sector, saved next to this script as au_timezone_grid.npy/.json (or to the path given with --grid).  When the grid
+exists it is memory mapped and used for every location inside a grid cell lying wholly in one zone (cells that any zone
+boundary, coastline or island outline passes through or next to are left to the exact lookup).  The global time
+zone data (timezonefinder) is only loaded for locations near zone borders or outside the grid.
+See benchmark_UTC_converter.py to compare start up time and rows/second with and without the grid.
+
 Troubleshooting
 
 If the script fails to run please check the following:
@@ -31,61 +49,233 @@ If the script fails to run please check the following:
 if the problem persists please contact us.
 
 '''
-from timezonefinder import TimezoneFinder
 import pandas as pd
-import pytz, datetime
-import readline
+import numpy as np
+import argparse
+import json
+import os
 #import glob
 
-readline.parse_and_bind("tab: complete")
+date_col = 'Date_sampled [YYYY-MM-DD]'
+time_col = 'Time_sampled [hh:mm]'
+lat_col = 'Latitude_(decimal_degrees)'
+lon_col = 'Longitude_(decimal_degrees)'
+
+tf = None #TimezoneFinder, made on the first zone lookup
+zone_cache = {} #zones found for "lat,lon" keys, saved to the cache file between runs
+
+#extent and cell size (degrees) of the precomputed zone grid: Australia, surrounding oceans and the Antarctic sector
+grid_bounds = {'lat_min': -90.0, 'lat_max': 0.0, 'lon_min': 70.0, 'lon_max': 170.0, 'res': 0.05}
+default_grid = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'au_timezone_grid')
+mixed_cell = np.iinfo(np.uint16).max #grid cells holding more than one zone
+grid_version = 2 #grids older than this did not mark the cells crossed by zone boundaries and are not used
+
+
+def zone_at(latitude, longitude):
+    #zone_cache is the only cache, convert() already looks up each distinct location once
+    global tf
+    key = repr(latitude) + ',' + repr(longitude)
+    if key not in zone_cache:
+        if tf is None:
+            from timezonefinder import TimezoneFinder
+            tf = TimezoneFinder()
+        zone_cache[key] = tf.timezone_at(lng=longitude, lat=latitude)
+    return zone_cache[key]
+
+
+def boundary_cells(finder, shape):
+    '''
+    Mark the grid cells crossed by any zone boundary (the outlines and holes of every zone polygon in the grid), and
+    the cells around them, so that coastlines, small islands and zone slivers lying between cell corners are not missed
+    '''
+    b = grid_bounds
+    crossed = np.zeros(shape, dtype=bool)
+    for zone in finder.timezone_names:
+        for polygon in finder.get_geometry(tz_name=zone, coords_as_pairs=False):
+            for xs, ys in polygon:
+                x = np.append(xs, xs[0])
+                y = np.append(ys, ys[0])
+                if x.max() < b['lon_min'] or x.min() > b['lon_max'] or y.max() < b['lat_min'] or y.min() > b['lat_max']:
+                    continue
+                #points along every edge, a quarter of a cell apart
+                dx, dy = np.diff(x), np.diff(y)
+                steps = np.maximum(np.ceil(np.maximum(abs(dx), abs(dy)) / (b['res'] / 4)).astype(int) + 1, 2)
+                edge = np.repeat(np.arange(len(dx)), steps)
+                t = (np.arange(len(edge)) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(steps - 1, steps)
+                i = np.floor((y[edge] + t * dy[edge] - b['lat_min']) / b['res']).astype(int)
+                j = np.floor((x[edge] + t * dx[edge] - b['lon_min']) / b['res']).astype(int)
+                inside = (i >= 0) & (i < shape[0]) & (j >= 0) & (j < shape[1])
+                crossed[i[inside], j[inside]] = True
+    #add the neighbouring cells
+    padded = np.pad(crossed, 1)
+    near = np.zeros(shape, dtype=bool)
+    for di in range(3):
+        for dj in range(3):
+            near |= padded[di:di + shape[0], dj:dj + shape[1]]
+    return near
+
+
+def build_zone_grid(grid):
+    '''
+    Look up the zone at every corner of the grid cells and save the zone of each cell whose four corners agree and
+    that no zone boundary passes through or near
+    '''
+    from timezonefinder import TimezoneFinder
+    finder = TimezoneFinder()
+    b = grid_bounds
+    lats = np.linspace(b['lat_min'], b['lat_max'], int(round((b['lat_max'] - b['lat_min']) / b['res'])) + 1)
+    lons = np.linspace(b['lon_min'], b['lon_max'], int(round((b['lon_max'] - b['lon_min']) / b['res'])) + 1)
+    names = {}
+    corners = np.empty((len(lats), len(lons)), dtype=np.uint16)
+    for i, lat in enumerate(lats):
+        for j, lon in enumerate(lons):
+            zone = finder.timezone_at(lng=lon, lat=lat)
+            corners[i, j] = mixed_cell if zone is None else names.setdefault(zone, len(names))
+    cells = corners[:-1, :-1].copy()
+    uniform = (cells == corners[1:, :-1]) & (cells == corners[:-1, 1:]) & (cells == corners[1:, 1:])
+    uniform &= ~boundary_cells(finder, cells.shape)
+    cells[~uniform] = mixed_cell
+    np.save(grid + '.npy', cells)
+    with open(grid + '.json', 'w') as f:
+        json.dump(dict(grid_bounds, zones=list(names), version=grid_version), f)
+    print("zone grid saved to: " + grid + ".npy (" + str(uniform.mean() * 100)[:5] + "% of cells in a single zone)")
+
+
+def load_zone_grid(grid):
+    '''
+    Memory map a zone grid made by build_zone_grid, or return None if it has not been built
+    '''
+    if not grid or not os.path.exists(grid + '.npy'):
+        return None
+    with open(grid + '.json') as f:
+        info = json.load(f)
+    if info.get('version', 1) < grid_version:
+        print("WARNING: zone grid " + grid + ".npy is out of date and was not used, rebuild it with --build-grid")
+        return None
+    return np.load(grid + '.npy', mmap_mode='r'), info
+
+
+def grid_zones(lats, lons, zone_grid):
+    '''
+    Return the grid zone of each location, or None where the location is outside the grid or in a mixed cell
+    '''
+    zones = np.full(len(lats), None, dtype=object)
+    if zone_grid is None:
+        return zones
+    cells, info = zone_grid
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    inside = (lats >= info['lat_min']) & (lats < info['lat_max']) & (lons >= info['lon_min']) & (lons < info['lon_max'])
+    i = ((lats[inside] - info['lat_min']) / info['res']).astype(int)
+    j = ((lons[inside] - info['lon_min']) / info['res']).astype(int)
+    codes = np.asarray(cells[i, j])
+    names = np.array(info['zones'] + [None], dtype=object)
+    zones[inside] = names[np.where(codes == mixed_cell, len(info['zones']), codes)]
+    return zones
+
+
+def load_zone_cache(cache_file):
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            zone_cache.update(json.load(f))
+
+
+def save_zone_cache(cache_file):
+    if cache_file:
+        with open(cache_file, 'w') as f:
+            json.dump(zone_cache, f)
+
+
+def localize(naive, zone):
+    '''
+    Localize naive times to a zone, returning the localized times (NaT where they could not be localized)
+    and the ambiguous and non-existent masks.  Like pytz localize(is_dst=None), times are never guessed.
+    '''
+    local = naive.dt.tz_localize(zone, ambiguous='NaT', nonexistent='NaT')
+    as_dst = naive.dt.tz_localize(zone, ambiguous=np.ones(len(naive), dtype=bool), nonexistent='NaT')
+    nonexistent = as_dst.isna() & naive.notna()
+    ambiguous = local.isna() & ~as_dst.isna()
+    return local, ambiguous, nonexistent
+
 
-input_file = input("PATH and name of csv file: ")
+def convert(df, zone_grid=None):
+    '''
+    Add UTC and zone columns to a dataframe with local date, time and location columns
+    Returns the dataframe and a list of (row, problem) for the rows that could not be converted
+    '''
+    #combine the date and time columns into the first column
+    naive = pd.to_datetime(df[date_col].astype(str) + ' ' + df[time_col].astype(str))
+    df = df.drop([date_col, time_col], axis=1)
+    #format the time stamp to remove the seconds
+    df.insert(0, 'Local_Date_Time', naive.dt.strftime('%Y-%m-%d %H:%M'))
+    naive = naive.dt.floor('min')
 
-output_file = input_file.replace(".csv", "") + "_UTC_converted.csv"
+    #find the zone of each unique location
+    locations = df[[lat_col, lon_col]].drop_duplicates()
+    zones = grid_zones(locations[lat_col], locations[lon_col], zone_grid)
+    zones = [zone if zone is not None else zone_at(lat, lon)
+             for zone, (lat, lon) in zip(zones, locations.itertuples(index=False))]
+    locations = locations.assign(zone=zones)
+    dt_zone = df[[lat_col, lon_col]].merge(locations, on=[lat_col, lon_col], how='left')['zone']
+    dt_zone.index = df.index
 
-print("output file is: " + output_file)
+    dt_UTC = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns, UTC]')
+    problems = [(i, "no timezone found") for i in df.index[dt_zone.isna()]]
+    for zone, rows in dt_zone.groupby(dt_zone).groups.items():
+        print("converting to UTC for timezone: " + zone + " (" + str(len(rows)) + " samples)")
+        local, ambiguous, nonexistent = localize(naive[rows], zone)
+        dt_UTC[rows] = local.dt.tz_convert('UTC')
+        problems.extend((i, "ambiguous local time in " + zone) for i in rows[ambiguous.to_numpy()])
+        problems.extend((i, "non-existent local time in " + zone) for i in rows[nonexistent.to_numpy()])
 
-#read in the contents of the file and combine the date and time columns
-df = pd.read_csv(input_file, parse_dates=[['Date_sampled [YYYY-MM-DD]', 'Time_sampled [hh:mm]']], engine='python')
+    #make a columns for converted time and time zone
+    df["UTC"] = dt_UTC.dt.strftime("%Y-%m-%d %H:%M:%S")
+    df['zone'] = dt_zone
+    #Split the time into db friendly columns
+    df['UTC_Date_sampled_(YYYY-MM-DD)'] = df['UTC'].str.split(' ').str[0]
+    df['UTC_Time_sampled_(hh:mm:ss)'] = df['UTC'].str.split(' ').str[1]
+    return df, sorted(problems)
 
-#change Date and ctime columns to a simpler form
-df = df.rename(columns={'Date_sampled [YYYY-MM-DD]_Time_sampled [hh:mm]': 'Local_Date_Time'})
 
-#forat the time stamp to remove the seconds
-df['Local_Date_Time'] = df['Local_Date_Time'].apply(lambda t: t.strftime('%Y-%m-%d %H:%M'))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert local date and time stamps to UTC")
+    parser.add_argument('input_file', nargs='?', help="csv file to convert (prompted for if not given)")
+    parser.add_argument('--zone-cache', help="JSON file to keep time zone lookups in between runs")
+    parser.add_argument('--grid', default=default_grid, help="path (without extension) of the precomputed zone grid")
+    parser.add_argument('--no-grid', action='store_true', help="look up every location in the global time zone data")
+    parser.add_argument('--build-grid', action='store_true', help="build the precomputed zone grid and exit")
+    args = parser.parse_args()
 
-tf = TimezoneFinder()
+    if args.build_grid:
+        build_zone_grid(args.grid)
+        parser.exit()
 
-dt_UTC = [] #create an empty list for the UTC times
-dt_zone = [] #create an empty list for the zones, just to check
+    if args.input_file:
+        input_file = args.input_file
+    else:
+        try:
+            import readline
+            readline.parse_and_bind("tab: complete")
+        except ImportError:
+            pass
+        input_file = input("PATH and name of csv file: ")
 
-for i in range(df.shape[0]):
+    output_file = input_file.replace(".csv", "") + "_UTC_converted.csv"
 
-    raw_dat = df.iloc[i].tolist()
-    #Get store positions of the lat and lon columns in the dataframe
-    lat_pos = df.columns.get_loc("Latitude_(decimal_degrees)")
-    lon_pos= df.columns.get_loc("Longitude_(decimal_degrees)")
-    #pass lat and lon positions
-    latitude, longitude = raw_dat[lat_pos], raw_dat[lon_pos]
-    zone=tf.timezone_at(lng=longitude, lat=latitude)
-    dt_zone.append(zone)
-    print("converting to UTC for timezone: " + zone)
-    local = pytz.timezone (zone) #set local time zone string
+    print("output file is: " + output_file)
 
-    dt_pos = df.columns.get_loc("Local_Date_Time")
-    naive = datetime.datetime.strptime (raw_dat[dt_pos], "%Y-%m-%d %H:%M")
-    local_dt = local.localize(naive, is_dst=None)
-    utc_dt = local_dt.astimezone(pytz.utc)
-    dt_UTC.append(utc_dt.strftime ("%Y-%m-%d %H:%M:%S"))
-#make a columns for converted time and time zone
+    #read in the contents of the file
+    df = pd.read_csv(input_file, engine='python')
 
-df["UTC"] = dt_UTC
-df['zone'] = dt_zone
-#Split the time into db friendly columns
-df['UTC_Date_sampled_(YYYY-MM-DD)'] = df['UTC'].apply(lambda x: x).str.split(' ').str[0]
-df['UTC_Time_sampled_(hh:mm:ss)'] = df['UTC'].apply(lambda x: x).str.split(' ').str[1]
+    load_zone_cache(args.zone_cache)
+    df, problems = convert(df, None if args.no_grid else load_zone_grid(args.grid))
+    save_zone_cache(args.zone_cache)
 
-#write out the dataframe to a csv file 
-df.to_csv(output_file, index = False)
-print("data written to: " + output_file)
+    #write out the dataframe to a csv file
+    df.to_csv(output_file, index = False)
+    print("data written to: " + output_file)
 
+    if problems:
+        print("\nWARNING: " + str(len(problems)) + " sample(s) could not be converted to UTC, check these rows:")
+        for i, problem in problems:
+            print("\trow " + str(i + 2) + " (" + str(df.loc[i, 'Sample_ID']) + "): " + problem)
@@ -1,44 +1,207 @@
 #!/usr/bin/python
 """
 This script extracts specified file types from tar.gz archives containing full SQM workflow outputs.
-Input should be a file with sample ids (one per line, without 102.100.100/), and a file with file types desired 
+Input should be a file with sample ids (one per line, without 102.100.100/), and a file with file types desired
 (one per line, e.g., "sqm.21.stats").  These files are made from the data request.
 
-The script will make and output directory per sample ID and extract the desired files to that directory.  
+The script will make and output directory per sample ID and extract the desired files to that directory.
 The output directories should not exist before running the script, if they do that sample will be skipped and a warning printed
+
+Each archive is read once from start to end and every member is checked against all of the file types, so the run time
+does not grow with the number of file types requested.  Archives of different samples are extracted at the same time
+in a pool of processes (one per core unless -p is given).  If pigz is installed it is used to decompress the archives,
+otherwise the python isal or zlib-ng gzip modules are used if installed, then python's own gzip.
+
+A manifest of the members of each archive (name, size and offset) is saved next to it as <archive>.manifest.json
+whenever an archive is read.  The manifest records the size and modification time of the archive and is ignored if
+the archive has changed.  Before extracting, the script reports which file types are missing for which samples using
+the manifests (archives without one are listed as not yet indexed), and skips archives holding none of the file types.
+With --dry-run only the report is made, reading the headers of any archives without a manifest first.
+
+The scan of each archive (and the time spent extracting within it) can be timed and logged with --log, and overall
+progress shown with --progress (see am_instrument.py).
+
+Usage:
+python metagenomeFileCollector.py [--ids ids.txt] [--types types.txt] [-p 4] [--dry-run] [--log collect.jsonl] [--progress]
 """
 
 
 import glob
+import json
 import tarfile
 import os
+import shutil
+import argparse
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import am_instrument
 
-#make a list of file types
-with open('types.txt') as f:
-    fileTypes = [line.rstrip() for line in f]
-    #print(fileTypes)
 
-#make a list of samples
-with open('ids.txt') as f:
-    samples = [line.rstrip() for line in f]
-    #print(samples)
+def open_archive(archive):
+    '''
+    Open a tar.gz archive as a stream, using the fastest gzip decompressor available.
+    Returns the tarfile and the pigz process (or None) to wait on once the archive is read
+    '''
+    if shutil.which('pigz'):
+        proc = subprocess.Popen(['pigz', '-dc', archive], stdout=subprocess.PIPE)
+        return tarfile.open(fileobj=proc.stdout, mode='r|'), proc
+    try:
+        from isal import igzip as fast_gzip
+    except ImportError:
+        try:
+            from zlib_ng import gzip_ng as fast_gzip
+        except ImportError:
+            fast_gzip = None
+    if fast_gzip is not None:
+        return tarfile.open(fileobj=fast_gzip.open(archive, 'rb'), mode='r|'), None
+    return tarfile.open(archive, 'r|gz'), None
 
 
-for sample in samples:
-    print("processing "+sample)
-    outdir = sample+"_out" #name ouput directory
-    isExist = os.path.exists(outdir) # Check whether the specified path exists or not, TRUE/FALSE
-    if not isExist:
-        os.mkdir(outdir) # Create a new directory because it does not exist
-        archive = glob.glob(sample+'*.tar.gz') #get the tar.gz file name for the sample SQM run
-        #print("Archive = "+archive[0])
-        t = tarfile.open(archive[0], 'r') #open the tar file
-        for type in fileTypes:
-            for member in t.getmembers(): #get the file contained in the acrhive
-                if type in member.name: #if the file type is in the list extract it
-                    print("extracting "+type)
+def manifest_path(archive):
+    return archive + '.manifest.json'
+
+
+def load_manifest(archive):
+    '''
+    Return the cached [name, size, offset] list of an archive's members, or None if there is no manifest or the archive has changed
+    '''
+    stat = os.stat(archive)
+    try:
+        with open(manifest_path(archive)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('size') != stat.st_size or manifest.get('mtime_ns') != stat.st_mtime_ns:
+        return None
+    return manifest['members']
+
+
+def save_manifest(archive, members):
+    stat = os.stat(archive)
+    manifest = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'members': members}
+    try:
+        with open(manifest_path(archive), 'w') as f:
+            json.dump(manifest, f)
+    except OSError:
+        print("WARNING:  could not save manifest "+manifest_path(archive))
+
+
+def read_archive(archive, fileTypes=(), outdir=None):
+    '''
+    Stream through an archive once, recording every member in its manifest and,
+    if outdir is given, extracting every member that matches any of the file types
+    '''
+    messages = []
+    members = []
+    t, proc = open_archive(archive)
+    with t, am_instrument.stage('scan', unit='members', file=archive) as scan:
+        for member in t: #get the files contained in the archive
+            members.append([member.name, member.size, member.offset_data])
+            scan.add(members=1, bytes=member.size)
+            matched = [type for type in fileTypes if type in member.name]
+            if matched and outdir is not None: #if the file type is in the list extract it
+                messages.append("extracting "+", ".join(matched))
+                with scan.timer('extract'):
                     t.extract(member, outdir)
+                scan.add(extracted=1, extracted_bytes=member.size)
+    if proc is not None:
+        proc.stdout.close()
+        if proc.wait() != 0:
+            messages.append("WARNING:  pigz failed to decompress "+archive)
+            return messages, None
+    save_manifest(archive, members)
+    return messages, members
+
+
+def extract_sample(sample, archive, outdir, fileTypes):
+    messages, members = read_archive(archive, fileTypes, outdir)
+    return "\n".join(["processing "+sample] + messages)
+
+
+def index_archive(archive):
+    messages, members = read_archive(archive)
+    return members
+
+
+def report(archives, fileTypes, manifests):
+    '''
+    Print which file types were not found for which samples, using the archive manifests
+    '''
+    print("\nFile type report (from archive manifests):")
+    complete = 0
+    for sample, archive in archives.items():
+        if archive is None:
+            print("\t"+sample+": no archive found")
+        elif manifests.get(sample) is None:
+            print("\t"+sample+": not yet indexed")
+        else:
+            names = [member[0] for member in manifests[sample]]
+            missing = [type for type in fileTypes if not any(type in name for name in names)]
+            if missing:
+                print("\t"+sample+": missing "+", ".join(missing))
+            else:
+                complete += 1
+    print("\t"+str(complete)+" of "+str(len(archives))+" samples have all "+str(len(fileTypes))+" file types\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extract file types from SQM run tar.gz archives")
+    parser.add_argument('--ids', default='ids.txt', help="file of sample ids, one per line (default: ids.txt)")
+    parser.add_argument('--types', default='types.txt', help="file of file types, one per line (default: types.txt)")
+    parser.add_argument('-p', '--processes', type=int, default=None, help="number of archives to extract at once (default: all cores)")
+    parser.add_argument('--dry-run', action='store_true', help="only report which file types are missing for which samples")
+    am_instrument.add_arguments(parser)
+    args = parser.parse_args()
+    am_instrument.configure_from_args(args)
+
+    #make a list of file types
+    with open(args.types) as f:
+        fileTypes = [line.rstrip() for line in f]
+        #print(fileTypes)
+
+    #make a list of samples
+    with open(args.ids) as f:
+        samples = [line.rstrip() for line in f]
+        #print(samples)
+
+    archives = {}
+    for sample in samples:
+        archive = glob.glob(sample+'*.tar.gz') #get the tar.gz file name for the sample SQM run
+        archives[sample] = archive[0] if archive else None
+    manifests = {sample: load_manifest(archive) for sample, archive in archives.items() if archive is not None}
+
+    if args.dry_run:
+        #read the headers of archives without a manifest
+        unindexed = [sample for sample, manifest in manifests.items() if manifest is None]
+        with ProcessPoolExecutor(max_workers=args.processes, initializer=am_instrument.configure, initargs=am_instrument.worker_settings()) as pool, \
+                am_instrument.stage('index', total=len(unindexed), unit='archives') as index:
+            for sample, members in zip(unindexed, pool.map(index_archive, [archives[sample] for sample in unindexed])):
+                manifests[sample] = members
+                index.add(archives=1)
+        report(archives, fileTypes, manifests)
     else:
-        print("WARNING:  output directory "+outdir+" already exists") #print warning if exists
+        report(archives, fileTypes, manifests)
+        with ProcessPoolExecutor(max_workers=args.processes, initializer=am_instrument.configure, initargs=am_instrument.worker_settings()) as pool:
+            jobs = []
+            for sample in samples:
+                outdir = sample+"_out" #name ouput directory
+                isExist = os.path.exists(outdir) # Check whether the specified path exists or not, TRUE/FALSE
+                if isExist:
+                    print("WARNING:  output directory "+outdir+" already exists") #print warning if exists
+                    continue
+                if archives[sample] is None:
+                    print("WARNING:  no archive found for "+sample)
+                    continue
+                members = manifests[sample]
+                if members is not None and not any(type in member[0] for member in members for type in fileTypes):
+                    print("WARNING:  none of the file types are in the archive for "+sample)
+                    continue
+                os.mkdir(outdir) # Create a new directory because it does not exist
+                jobs.append(pool.submit(extract_sample, sample, archives[sample], outdir, fileTypes))
+            with am_instrument.stage('extract', total=len(jobs), unit='archives') as extract:
+                for job in jobs:
+                    print(job.result())
+                    extract.add(archives=1)
 
-print("Extraction complete")
+        print("Extraction complete")
+    am_instrument.event('finished', samples=len(samples))
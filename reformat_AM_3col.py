@@ -15,40 +15,257 @@ csv.
 
 Output is a rectangular table and includes the taxonomy contained in the downloaded 3 column table.
 
+Two pivot modes are available:
+    1) standard - the whole table is read and pivoted in memory with pandas
+    2) sparse   - the table is read in chunks, OTU and Sample IDs are encoded to integers and the counts
+                  are held in a scipy.sparse matrix.  The wide table is written out a block of rows at a time
+                  so the dense OTU x Sample table is never held in memory.  Use this for full portal exports.
+                  Requires scipy (`pip install scipy`)
+
+Both modes write the same output table.
+
+The output can be written as csv (the default), parquet, scipy sparse npz or MatrixMarket (mtx).
+See am_wide_table.py for the files written for each format and for a loader to reopen them.
+
+New portal downloads can be added to an existing wide table (mode 3) without starting again from the full download:
+    3) incremental - the existing wide table (csv, parquet, npz or mtx as written by this script) is loaded and the
+                  new 3 column download (the delta) is read as in sparse mode and checked the same way.  Samples in the
+                  delta that are not yet in the table are appended as new columns and OTUs not yet in the table as new
+                  rows (with their taxonomy), all missing cells are 0.  Samples already in the table are skipped.
+
+The input table is read with am_long_table.py, which stores the names and taxonomy as categoricals and the counts as
+uint32 so the long table takes several times less memory.  It can be plain csv or compressed (.gz, .bgz or .zst).
+
+The read, pivot, merge and write stages can be timed and their rows, rate and memory logged with --log, --progress
+and --profile (see am_instrument.py), e.g., `python reformat_AM_3col.py --log reformat.jsonl --progress`
+
 """
 
-infile=input("path to input file: ")
-output=input("name of your output file: ")
-expected_cols=['Sample ID','OTU','OTU Count','Amplicon','Kingdom','Phylum','Class','Order','Family','Genus','Species', 'Traits']
+import os
+import argparse
+import numpy as np
 import pandas as pd
-#read the long table in
+import am_instrument
+import am_long_table
+import am_wide_table
+
+expected_cols = am_long_table.expected_cols
+taxonomy = am_long_table.taxonomy
 
-print("Reading "+infile)
 
-tableL = pd.read_csv(infile)
+def dense_pivot(infile, output, fmt='csv'):
+    #read the long table in
+    print("Reading "+infile)
 
+    if not am_long_table.check_header(infile):
+        print("input table is not in expexted format")
+        return
+
+    with am_instrument.stage('read', file=infile) as read:
+        tableL = am_long_table.read_table(infile, progress=read)
+        read.add(bytes=os.path.getsize(infile))
 
-if tableL.columns.tolist()!=expected_cols:
-    print("input table is not in expexted format")
-else:
     print("pivoting "+infile)
-    #pivot the table out to wide format, fill 'na' with 0 to make the OTU table
-    tableW = tableL.pivot_table(index='OTU', columns='Sample ID', values='OTU Count').fillna(0)
+    with am_instrument.stage('pivot', file=infile):
+        #pivot the table out to wide format, fill 'na' with 0 to make the OTU table
+        tableW = tableL.pivot_table(index='OTU', columns='Sample ID', values='OTU Count', observed=True).fillna(0)
+
+    if tableW.values.sum() == tableL['OTU Count'].sum(): #check the table values
+        print("adding taxonomy")
+
+        with am_instrument.stage('merge', file=infile):
+            #add the taxonomy back in
+            taxL = tableL[taxonomy] #get the taxonomy data
+            taxL1 = taxL.drop_duplicates(keep='first').set_index('OTU') #remove the duplicates
+            merge=pd.merge(tableW,taxL1,left_index=True, right_index=True, how='inner') #merge the OTU abundance and taxonomies
+
+    else:
+        print("error: abundance of input table != abundance of pivoted table")
+        return
+
+    if merge.drop(taxonomy[1:], axis=1).values.sum() ==  tableL['OTU Count'].sum():
+        with am_instrument.stage('write', total=len(merge), file=output) as write:
+            if fmt == 'csv':
+                #write the table out a block of rows at a time
+                with open(output+'.csv', 'w', newline='') as out:
+                    for start, end in am_wide_table.row_blocks(len(merge), len(merge.columns)):
+                        merge.iloc[start:end].to_csv(out, header=(start == 0))
+                        write.add(rows=end - start)
+                    if not len(merge):
+                        merge.to_csv(out)
+            else:
+                from scipy import sparse
+                counts = merge.drop(taxonomy[1:], axis=1)
+                am_wide_table.write_wide_table(output, fmt, sparse.csr_matrix(counts.values), counts.index, counts.columns, merge[taxonomy[1:]], progress=write)
+        print(".....finished!")
+    else:
+        print("error merging taxonomies")
+
+
+def read_sparse(infile):
+    '''
+    Read a long table in chunks into a scipy.sparse CSR matrix (OTU x Sample)
+
+    Returns the matrix, the OTU and Sample ID labels (both sorted, as pivot_table would),
+    the per OTU taxonomy lookup and the total abundance of the input table.
+    Rows with no OTU or Sample ID are left out of the matrix (but not the total), so the abundance check fails
+    on them as it does in standard mode.
+    Returns None if the input table is not in the expected format.
+    '''
+    from scipy import sparse
+
+    print("Reading "+infile)
+    if not am_long_table.check_header(infile):
+        print("input table is not in expexted format")
+        return None
+
+    otu_codes = {}
+    sample_codes = {}
+    rows = []
+    cols = []
+    counts = []
+    tax_parts = []
+    total = 0
+    with am_instrument.stage('read', file=infile) as read:
+        for chunk in am_long_table.iter_table(infile):
+            total += chunk['OTU Count'].sum()
+            chunk = chunk[chunk['OTU'].notna() & chunk['Sample ID'].notna()]
+            n_otus = len(otu_codes)
+            otu_idx = am_long_table.encode(chunk['OTU'], otu_codes)
+            rows.append(otu_idx)
+            cols.append(am_long_table.encode(chunk['Sample ID'], sample_codes))
+            counts.append(chunk['OTU Count'].to_numpy(dtype=np.float64))
+            #only keep the taxonomy of OTUs seen for the first time, so the lookup has one row per OTU
+            tax_parts.append(chunk.loc[otu_idx >= n_otus, taxonomy].drop_duplicates(subset='OTU', keep='first'))
+            read.add(rows=len(chunk))
+        read.add(bytes=os.path.getsize(infile))
+
+    print("pivoting "+infile)
+    with am_instrument.stage('pivot', file=infile):
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        counts = np.concatenate(counts)
+        shape = (len(otu_codes), len(sample_codes))
+        tableW = sparse.csr_matrix((counts, (rows, cols)), shape=shape)
+        #pivot_table takes the mean of repeated OTU/Sample ID entries, so do the same
+        n_entries = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+        if n_entries.nnz < len(rows):
+            tableW = tableW.multiply(n_entries.power(-1)).tocsr()
+        del rows, cols, counts, n_entries
+
+        #put the OTUs and samples in sorted order
+        otus = pd.Index(list(otu_codes))
+        samples = pd.Index(list(sample_codes))
+        otu_order = otus.argsort()
+        sample_order = samples.argsort()
+        tableW = tableW[otu_order][:, sample_order]
+        otus = otus[otu_order]
+        samples = samples[sample_order]
+
+    with am_instrument.stage('merge', file=infile):
+        taxL1 = pd.concat(tax_parts).set_index('OTU').reindex(otus)
+    return tableW, otus, samples, taxL1, total
+
+
+def sparse_pivot(infile, output, fmt='csv'):
+    result = read_sparse(infile)
+    if result is None:
+        return
+    tableW, otus, samples, taxL1, total = result
+
+    if tableW.sum() != total: #check the table values
+        print("error: abundance of input table != abundance of pivoted table")
+        return
 
-if tableW.values.sum() == tableL['OTU Count'].sum(): #check the table values
     print("adding taxonomy")
+    #the wide table is written a block of OTUs at a time
+    with am_instrument.stage('write', total=len(otus), file=output) as write:
+        written = am_wide_table.write_wide_table(output, fmt, tableW, otus, samples, taxL1, progress=write)
+
+    if written == total:
+        print(".....finished!")
+    else:
+        for f in am_wide_table.output_files(output, fmt):
+            os.remove(f)
+        print("error merging taxonomies")
+
+
+def incremental_merge(existing, delta, output, fmt='csv'):
+    from scipy import sparse
+
+    print("Reading "+existing)
+    with am_instrument.stage('read', file=existing) as read:
+        tableW, otus, samples, taxL1 = am_wide_table.load_wide_table(existing)
+        read.add(rows=len(otus))
+    existing_total = tableW.sum()
+
+    result = read_sparse(delta)
+    if result is None:
+        return
+    deltaW, delta_otus, delta_samples, delta_tax, delta_total = result
+    if deltaW.sum() != delta_total: #check the delta table values
+        print("error: abundance of input table != abundance of pivoted table")
+        return
+
+    #only append samples that are not already in the table
+    new_samples = ~delta_samples.isin(samples)
+    if not new_samples.all():
+        print("WARNING: " + str((~new_samples).sum()) + " sample(s) already in " + existing + " were skipped")
+    deltaW = deltaW.tocsc()[:, np.flatnonzero(new_samples)]
+    delta_samples = delta_samples[new_samples]
+    added_total = deltaW.sum()
+
+    print("adding " + str(len(delta_samples)) + " samples")
+    with am_instrument.stage('merge', file=delta):
+        #new OTUs (with counts in the samples being added) are added as rows after the existing ones, with zeros in
+        #the existing samples
+        present = np.diff(deltaW.tocsr().indptr) > 0
+        new_otus = delta_otus[present & ~delta_otus.isin(otus)]
+        all_otus = otus.append(new_otus)
+        tableW = sparse.vstack([tableW, sparse.csr_matrix((len(new_otus), len(samples)))])
+        deltaW = deltaW.tocoo()
+        rows = all_otus.get_indexer(delta_otus)[deltaW.row]
+        deltaW = sparse.csr_matrix((deltaW.data, (rows, deltaW.col)), shape=(len(all_otus), len(delta_samples)))
+        merged = sparse.hstack([tableW, deltaW], format='csr')
+        taxL1 = pd.concat([taxL1, delta_tax.loc[new_otus]])
+        taxL1.index.name = 'OTU'
+    if merged.sum() != existing_total + added_total:
+        print("error: abundance of merged table != abundance of existing table and new samples")
+        return
+
+    print("adding taxonomy for " + str(len(new_otus)) + " new OTUs")
+    with am_instrument.stage('write', total=len(all_otus), file=output) as write:
+        written = am_wide_table.write_wide_table(output, fmt, merged, all_otus, samples.append(delta_samples), taxL1, progress=write)
+
+    if written == existing_total + added_total:
+        print(".....finished!")
+    else:
+        for f in am_wide_table.output_files(output, fmt):
+            os.remove(f)
+        print("error merging taxonomies")
 
-    #add the taxonomy back in
-    taxonomy = ['OTU','Amplicon','Kingdom','Phylum','Class','Order','Family','Genus','Species', 'Traits']
-    taxL = tableL[taxonomy] #get the taxonomy data
-    taxL1 = taxL.drop_duplicates(keep='first').set_index('OTU') #remove the duplicates
-    merge=pd.merge(tableW,taxL1,left_index=True, right_index=True, how='inner') #merge the OTU abundance and taxonomies
 
-else:
-    print("error: abundance of input table != abundance of pivoted table")
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reformat an AM 3 column table to a wide table. Prompts for the files and mode.")
+    am_instrument.add_arguments(parser)
+    am_instrument.configure_from_args(parser.parse_args())
 
-if merge.drop(['Amplicon','Kingdom','Phylum','Class','Order','Family','Genus','Species', 'Traits'], axis=1).values.sum() ==  tableL['OTU Count'].sum():
-    merge.to_csv(output+'.csv') #write the table out
-    print(".....finished!")
-else:
-    print("error merging taxonomies")
+    infile=input("path to input file: ")
+    output=input("name of your output file: ")
+    print("Pivot mode:")
+    print("\tEnter 1 for standard (whole table in memory)")
+    print("\tEnter 2 for sparse (chunked, for large tables)")
+    print("\tEnter 3 for incremental (add the input file to an existing wide table)")
+    mode = input("Enter 1, 2 or 3: ")
+    if mode == '3':
+        existing = input("path to existing wide table: ")
+    fmt = input("Output format - csv, parquet, npz or mtx (hit enter for csv): ").strip() or 'csv'
+    if fmt not in am_wide_table.formats:
+        print("unknown output format: " + fmt)
+    elif mode == '2':
+        sparse_pivot(infile, output, fmt)
+    elif mode == '3':
+        incremental_merge(existing, infile, output, fmt)
+    else:
+        dense_pivot(infile, output, fmt)
+    am_instrument.event('finished', file=infile)
@@ -1,38 +1,264 @@
 '''
 A script to retrieve a list of samples from an abundance table downloaded from Austrlain Microbiome bpa-otu.
 Input is: 1) the downloaded table, comma seperated, typically with sampleID, ASVID, count and taxonomy information.
-        2) a file comprising a list of sampleID's to keep, one per line.  
+        2) a file comprising a list of sampleID's to keep, one per line.
 Output is the same format and a table comprising a subset of the original containing only the desired sample ID's
 in the `Sample_only` column
 
+The input table can also be a wide table written by reformat_AM_3col.py in parquet, npz or mtx format.  Only the
+columns of the desired sample ID's are read and the result is written in the format of the result table's extension
+(.csv, .parquet, .npz or .mtx, the input's format if it has none, see am_wide_table.py).
+
+The first time a 3 col table is subset, an index of the byte ranges holding each Sample ID's rows is saved next to
+it as <table>.sidx.npz (numpy arrays).  Later requests on the same table only read the rows of the desired sample ID's.
+The index records the size and modification time of the table and is rebuilt automatically if the table changes.
+The index only helps when each sample's rows are together in the table (as in portal downloads).  If they are
+scattered (more than max_ranges_per_sample ranges per sample) indexing stops, the index records that the table is
+fragmented and the table is filtered in streaming mode instead.
+
+Compressed tables (.gz, .bgz or .zst) are read in streaming mode: the table is cut into chunks on line boundaries
+which are filtered in parallel by a pool of processes and written out in their original order.  Streaming mode can
+also be chosen for plain tables with --stream (each process then reads its own byte range of the file).  The result
+table is compressed if its name ends with .gz, .bgz (bgzip blocks) or .zst.  Reading or writing .zst needs zstandard (`pip install zstandard`)
+Tables are opened with am_long_table.py, shared with reformat_AM_3col.py.
+
 usage:  python sub_sample_AM_zotuTABLE_by_sample_id.py
+            > enter the file paths at the prompts
+        python sub_sample_AM_zotuTABLE_by_sample_id.py -s ids.txt -i table.csv.gz -o subset.csv.gz [-p 8] [--stream]
+            > non-interactive, for batch pipelines
 
 '''
-import readline
-readline.parse_and_bind("tab: complete")
+import os
+import argparse
+from collections import deque
+from multiprocessing import Pool
+import numpy as np
+import am_long_table
+from am_long_table import open_table
+
+#size in bytes of the chunks filtered by each process in streaming mode
+chunk_size = 64 * 1024 * 1024
 
-sample_file = input("PATH to sample ID list: ")
-otuTABLE = input("PATH to 3 col format input table: ")
-output_table = input("PATH to result table: ")
+compressed_exts = ('.gz', '.bgz', '.zst')
 
-samples_to_keep=set()
+#tables whose samples are split into more row ranges than this on average are not indexed, seeking to every range
+#would be slower than reading the whole table.  Indexing stops as soon as this is clear (once past min_ranges ranges)
+max_ranges_per_sample = 4
+min_ranges = 100000
 
-def get_unique_samples():
-   # samples_to_keep = set()
+def get_unique_samples(sample_file):
+    samples_to_keep = set()
     with open(sample_file, 'r', encoding='utf-8-sig') as list_file:
         for line in list_file:
             if line.strip():
                 samples_to_keep.add(line.strip())
+    return samples_to_keep
+
+def sample_column(header):
+    #position of the Sample ID column from the header line of a table
+    return am_long_table.sample_column(header.decode('utf-8-sig').rstrip('\r\n').split(','))
+
+def index_path(table):
+    return table + '.sidx.npz'
+
+def build_sample_index(table):
+    '''
+    Scan a 3 col table once and record the byte ranges of the rows of each Sample ID.
+    Consecutive rows of the same sample are stored as a single range.  The ranges are saved sorted by sample, with
+    sample_ptr giving the first range of each sample.  Scanning stops if the table turns out to be fragmented.
+    '''
+    stat = os.stat(table)
+    sample_ids = {}
+    range_samples, starts, ends = [], [], []
+    fragmented = False
+    with open(table, 'rb') as otu_table:
+        header = otu_table.readline()
+        sample_col = sample_column(header)
+        pos = len(header)
+        current, start = None, pos
+        for line in otu_table:
+            sample = line.split(b',', sample_col + 1)[sample_col].strip(b'"\r\n')
+            if sample != current:
+                if current is not None:
+                    range_samples.append(sample_ids.setdefault(current, len(sample_ids)))
+                    starts.append(start)
+                    ends.append(pos)
+                    if len(starts) > min_ranges and len(starts) > max_ranges_per_sample * len(sample_ids):
+                        fragmented = True
+                        break
+                current, start = sample, pos
+            pos += len(line)
+        if current is not None and not fragmented:
+            range_samples.append(sample_ids.setdefault(current, len(sample_ids)))
+            starts.append(start)
+            ends.append(pos)
+    if len(starts) > max_ranges_per_sample * len(sample_ids):
+        fragmented = True
+    if fragmented:
+        print("the rows of each sample are not together in " + table + ", it will be filtered in streaming mode")
+        sample_ids, range_samples, starts, ends = {}, [], [], []
+    order = np.argsort(np.array(range_samples, dtype=np.int64), kind='stable')
+    index = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'header_end': len(header), 'fragmented': fragmented,
+             'samples': np.array([sample.decode() for sample in sample_ids], dtype=str),
+             'sample_ptr': np.searchsorted(np.array(range_samples, dtype=np.int64)[order], np.arange(len(sample_ids) + 1)),
+             'starts': np.array(starts, dtype=np.int64)[order], 'ends': np.array(ends, dtype=np.int64)[order]}
+    try:
+        with open(index_path(table), 'wb') as index_file:
+            np.savez(index_file, **index)
+    except OSError:
+        print("WARNING: could not save sample index " + index_path(table))
+    return index
+
+def get_sample_index(table):
+    '''
+    Load the sample index of a table, building it if it is missing or the table has changed since it was made
+    '''
+    stat = os.stat(table)
+    try:
+        with np.load(index_path(table), allow_pickle=False) as saved:
+            index = {key: saved[key] for key in saved.files}
+        for key in ('size', 'mtime_ns', 'header_end', 'fragmented'):
+            index[key] = index[key].item()
+        if index['size'] == stat.st_size and index['mtime_ns'] == stat.st_mtime_ns:
+            return index
+        print("sample index is out of date, rebuilding")
+    except (OSError, ValueError, KeyError):
+        print("indexing " + table)
+    return build_sample_index(table)
+
+def subset_3col_table(otuTABLE, samples_to_keep, output_table, processes=None):
+    index = get_sample_index(otuTABLE)
+    if index['fragmented']:
+        subset_3col_table_stream(otuTABLE, samples_to_keep, output_table, processes)
+        return
+    #copy the header then the row ranges of the wanted samples, in their original order
+    positions = {sample: i for i, sample in enumerate(index['samples'].tolist())}
+    ptr = index['sample_ptr']
+    wanted = [positions[sample] for sample in samples_to_keep if sample in positions]
+    ranges = [(0, index['header_end'])]
+    for i in wanted:
+        ranges.extend(zip(index['starts'][ptr[i]:ptr[i + 1]].tolist(), index['ends'][ptr[i]:ptr[i + 1]].tolist()))
+    ranges.sort()
+    #join ranges that follow on from each other so they are copied with one seek
+    merged = [list(ranges[0])]
+    for start, end in ranges[1:]:
+        if start == merged[-1][1]:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    with open(otuTABLE, 'rb') as otu_table:
+        with open_table(output_table, 'w') as subset_table:
+            for start, end in merged:
+                otu_table.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    block = otu_table.read(min(remaining, 1 << 20))
+                    subset_table.write(block)
+                    remaining -= len(block)
+
+#set in each worker process by init_worker
+worker_samples = None
+worker_col = 0
+
+def init_worker(samples_to_keep, sample_col):
+    global worker_samples, worker_col
+    worker_samples = set(sample.encode() for sample in samples_to_keep)
+    worker_col = sample_col
+
+def filter_chunk(task):
+    '''
+    Keep the lines of a chunk whose Sample ID is wanted.  The task is either a chunk of bytes or
+    a (path, start, end) byte range of an uncompressed table, with start and end on line boundaries
+    '''
+    if isinstance(task, tuple):
+        path, start, end = task
+        with open(path, 'rb') as otu_table:
+            otu_table.seek(start)
+            task = otu_table.read(end - start)
+    samples, col = worker_samples, worker_col
+    kept = [line for line in task.splitlines(keepends=True)
+            if line.split(b',', col + 1)[col].strip(b'"') in samples]
+    return b''.join(kept)
+
+def stream_chunks(otu_table):
+    '''
+    Yield chunks of about chunk_size bytes from an open table, each ending on a line boundary
+    '''
+    while True:
+        chunk = otu_table.read(chunk_size)
+        if not chunk:
+            return
+        if not chunk.endswith(b'\n'):
+            chunk += otu_table.readline()
+        yield chunk
+
+def range_chunks(path, start):
+    '''
+    Yield (path, start, end) byte ranges of about chunk_size bytes of an uncompressed table, split on line boundaries
+    '''
+    size = os.path.getsize(path)
+    with open(path, 'rb') as otu_table:
+        while start < size:
+            otu_table.seek(min(start + chunk_size, size))
+            otu_table.readline()
+            end = min(otu_table.tell(), size)
+            yield (path, start, end)
+            start = end
+
+def subset_3col_table_stream(otuTABLE, samples_to_keep, output_table, processes=None):
+    with open_table(otuTABLE, 'r') as otu_table, open_table(output_table, 'w') as subset_table:
+        header = otu_table.readline()
+        subset_table.write(header)
+        if otuTABLE.endswith(compressed_exts):
+            tasks = stream_chunks(otu_table)
+        else:
+            tasks = range_chunks(otuTABLE, len(header))
+        with Pool(processes, initializer=init_worker, initargs=(samples_to_keep, sample_column(header))) as pool:
+            #keep a bounded number of chunks in flight and write the results in input order
+            max_pending = 2 * (processes or os.cpu_count() or 1)
+            pending = deque()
+            for task in tasks:
+                pending.append(pool.apply_async(filter_chunk, (task,)))
+                if len(pending) >= max_pending:
+                    subset_table.write(pending.popleft().get())
+            while pending:
+                subset_table.write(pending.popleft().get())
+
+def subset_wide_table(otuTABLE, samples_to_keep, output_table):
+    import am_wide_table
+    fmt_of = {v: k for k, v in am_wide_table.formats.items()}
+    output, ext = os.path.splitext(output_table)
+    if ext and ext not in fmt_of:
+        print("unknown output format: " + ext + ", a wide table can be written as " + ", ".join(fmt_of))
+        return
+    fmt = fmt_of[ext or os.path.splitext(otuTABLE)[1]]
+    tableW, otus, samples, taxL1 = am_wide_table.load_wide_table(otuTABLE, samples=samples_to_keep)
+    am_wide_table.write_wide_table(output, fmt, tableW, otus, samples, taxL1)
 
-def subset_3col_table():
-    with open(otuTABLE, 'r') as otu_table:
-        with open(output_table, 'w') as subset_table:
-            subset_table.write(otu_table.readline())
-            for line in otu_table:
-                if set(line.split(',')[:-1]) & samples_to_keep:
-                    subset_table.write(line)
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Subset an AM abundance table to a list of sample ID's. Prompts for any paths not given.")
+    parser.add_argument('-s', '--samples', help="file of sample ID's to keep, one per line")
+    parser.add_argument('-i', '--input', help="3 col format input table (.csv, .csv.gz, .csv.bgz or .csv.zst) or wide table (.parquet, .npz, .mtx)")
+    parser.add_argument('-o', '--output', help="result table, compressed if it ends with .gz, .bgz or .zst (for a wide table: .csv, .parquet, .npz or .mtx)")
+    parser.add_argument('-p', '--processes', type=int, default=None, help="number of processes in streaming mode (default: all cores)")
+    parser.add_argument('--stream', action='store_true', help="use streaming mode for an uncompressed table instead of the sample index")
+    args = parser.parse_args()
 
-get_unique_samples()
-subset_3col_table()
+    if args.samples is None or args.input is None or args.output is None:
+        try:
+            import readline
+            readline.parse_and_bind("tab: complete")
+        except ImportError:
+            pass
+    sample_file = args.samples or input("PATH to sample ID list: ")
+    otuTABLE = args.input or input("PATH to 3 col format input table: ")
+    output_table = args.output or input("PATH to result table: ")
 
+    samples_to_keep = get_unique_samples(sample_file)
+    if os.path.splitext(otuTABLE)[1] in ('.parquet', '.npz', '.mtx'):
+        subset_wide_table(otuTABLE, samples_to_keep, output_table)
+    elif args.stream or otuTABLE.endswith(compressed_exts):
+        subset_3col_table_stream(otuTABLE, samples_to_keep, output_table, args.processes)
+    else:
+        subset_3col_table(otuTABLE, samples_to_keep, output_table, args.processes)